@@ -0,0 +1,404 @@
+#!/usr/bin/env python3
+"""
+Benchmarks datagetter.py end to end against a synthetic registry served by a
+local publisher server with configurable latency, bandwidth and error rate.
+
+Each --threads value is run with a cold cache and then again with the cache
+the cold run left (warm). Results are printed and written to --output as JSON,
+including the per-phase timings from the run's metrics.json.
+
+e.g.
+$ benchmarks/benchmark.py --datasets 40 --sizes 100,10000 --threads 1,4,8 \\
+    --latency 0.1 --bandwidth 2M --error-rate 0.05 -- --pipeline
+"""
+import argparse
+import csv
+import http.server
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import threading
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from datagetter import parse_size  # noqa: E402
+
+FORMATS = ["json", "xlsx", "csv", "ods"]
+
+# 360Giving spreadsheet column titles and the grant fields they unflatten to
+COLUMNS = [
+    ("Identifier", "id"),
+    ("Title", "title"),
+    ("Description", "description"),
+    ("Currency", "currency"),
+    ("Amount Awarded", "amountAwarded"),
+    ("Award Date", "awardDate"),
+    ("Recipient Org:Identifier", "recipientOrganization/0/id"),
+    ("Recipient Org:Name", "recipientOrganization/0/name"),
+    ("Funding Org:Identifier", "fundingOrganization/0/id"),
+    ("Funding Org:Name", "fundingOrganization/0/name"),
+]
+
+# Bytes written at a time when throttling a response to the --bandwidth
+SEND_CHUNK_SIZE = 16 * 1024
+
+
+def synthetic_grant(dataset_index, grant_index):
+    return {
+        "id": f"360G-BENCH-{dataset_index}-{grant_index}",
+        "title": f"Benchmark grant {grant_index}",
+        "description": "A synthetic grant for benchmarking the datagetter",
+        "currency": "GBP",
+        "amountAwarded": 1000 + grant_index,
+        "awardDate": "2020-01-01",
+        "recipientOrganization": [
+            {"id": f"GB-CHC-{grant_index:07d}", "name": f"Recipient {grant_index}"}
+        ],
+        "fundingOrganization": [
+            {"id": f"GB-CHC-BENCH{dataset_index}", "name": "Benchmark Trust"}
+        ],
+    }
+
+
+def grant_row(grant):
+    row = []
+    for _, path in COLUMNS:
+        value = grant
+        for key in path.split("/"):
+            value = value[int(key)] if isinstance(value, list) else value[key]
+        row.append(value)
+    return row
+
+
+def write_xlsx(file_path, rows):
+    import openpyxl
+
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = workbook.create_sheet("grants")
+    for row in rows:
+        sheet.append(row)
+    workbook.save(file_path)
+
+
+def write_ods(file_path, rows):
+    from odf.opendocument import OpenDocumentSpreadsheet
+    from odf.table import Table, TableCell, TableRow
+    from odf.text import P
+
+    document = OpenDocumentSpreadsheet()
+    table = Table(name="grants")
+    for row in rows:
+        table_row = TableRow()
+        for value in row:
+            if isinstance(value, (int, float)):
+                cell = TableCell(valuetype="float", value=value)
+            else:
+                cell = TableCell(valuetype="string")
+            cell.addElement(P(text=str(value)))
+            table_row.addElement(cell)
+        table.addElement(table_row)
+    document.spreadsheet.addElement(table)
+    document.save(file_path)
+
+
+def write_dataset(file_path, file_type, dataset_index, size):
+    grants = [synthetic_grant(dataset_index, i) for i in range(size)]
+
+    if file_type == "json":
+        with open(file_path, "w") as fp:
+            json.dump({"grants": grants}, fp)
+        return
+
+    rows = [[title for title, _ in COLUMNS]] + [grant_row(grant) for grant in grants]
+
+    if file_type == "csv":
+        with open(file_path, "w", newline="") as fp:
+            csv.writer(fp).writerows(rows)
+    elif file_type == "xlsx":
+        write_xlsx(file_path, rows)
+    elif file_type == "ods":
+        write_ods(file_path, rows)
+
+
+def generate(work_dir, datasets, sizes, formats, base_url):
+    """
+    Writes the synthetic publisher files to work_dir/www (unless they exist
+    from a previous benchmark) and returns the registry listing them. Dataset
+    n has the nth size and format, cycling through each list.
+    """
+    www_dir = os.path.join(work_dir, "www")
+    os.makedirs(www_dir, exist_ok=True)
+
+    registry = []
+    for index in range(datasets):
+        size = sizes[index % len(sizes)]
+        file_type = formats[index % len(formats)]
+        file_name = f"dataset-{index}-{size}.{file_type}"
+
+        file_path = os.path.join(www_dir, file_name)
+        if not os.path.exists(file_path):
+            print(f"Generating {file_name}")
+            write_dataset(file_path, file_type, index, size)
+
+        registry.append(
+            {
+                "title": f"Benchmark dataset {index}",
+                "description": "",
+                "identifier": f"benchmark-{index}",
+                "license": "https://creativecommons.org/licenses/by/4.0/",
+                "license_name": "Creative Commons Attribution 4.0 International (CC BY 4.0)",
+                "issued": "2020-01-01",
+                "modified": "2020-01-01T00:00:00.000+0000",
+                "publisher": {
+                    "name": f"Benchmark publisher {index}",
+                    "prefix": f"360G-BENCH{index}",
+                },
+                "distribution": [
+                    {
+                        "downloadURL": f"{base_url}/{file_name}",
+                        "accessURL": "",
+                        "title": file_name,
+                    }
+                ],
+            }
+        )
+
+    return registry
+
+
+class PublisherHandler(http.server.SimpleHTTPRequestHandler):
+    """Serves files after a delay, at a limited bandwidth, with random errors"""
+
+    def __init__(self, *args, latency=0, bandwidth=None, should_fail=None, **kwargs):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.should_fail = should_fail
+        super().__init__(*args, **kwargs)
+
+    def do_GET(self):
+        time.sleep(self.latency)
+
+        if self.should_fail and self.should_fail():
+            self.send_error(500, "Synthetic error")
+            return
+
+        super().do_GET()
+
+    def copyfile(self, source, outputfile):
+        if not self.bandwidth:
+            return super().copyfile(source, outputfile)
+
+        while chunk := source.read(SEND_CHUNK_SIZE):
+            time.sleep(len(chunk) / self.bandwidth)
+            outputfile.write(chunk)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(www_dir, latency, bandwidth, error_rate, seed):
+    """Serves www_dir on a free port in a background thread. Returns the server"""
+    errors_random = random.Random(seed)
+    errors_lock = threading.Lock()
+
+    def should_fail():
+        with errors_lock:
+            return errors_random.random() < error_rate
+
+    def handler(*args, **kwargs):
+        return PublisherHandler(
+            *args,
+            latency=latency,
+            bandwidth=bandwidth,
+            should_fail=should_fail,
+            directory=www_dir,
+            **kwargs,
+        )
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def run_datagetter(run_dir, registry_path, threads, datagetter_args):
+    """
+    Runs datagetter.py in run_dir (where its cache lives) and returns the wall
+    time, the peak RSS of its largest process and its metrics.json
+    """
+    data_dir = os.path.join(run_dir, "data")
+    shutil.rmtree(data_dir, ignore_errors=True)
+
+    command = [
+        sys.executable,
+        os.path.join(REPO_DIR, "datagetter.py"),
+        "--local-registry",
+        registry_path,
+        "--data-dir",
+        data_dir,
+        "--threads",
+        str(threads),
+        *datagetter_args,
+    ]
+
+    start = time.perf_counter()
+    with open(os.path.join(run_dir, "datagetter.log"), "a") as log:
+        process = subprocess.Popen(command, cwd=run_dir, stdout=log, stderr=log)
+        # Unlike getrusage, wait4 gives the usage of this run alone (including
+        # the pool processes it waited for)
+        _, status, usage = os.wait4(process.pid, 0)
+    wall_time = time.perf_counter() - start
+
+    if status != 0:
+        raise RuntimeError(f"datagetter.py failed, see {run_dir}/datagetter.log")
+
+    with open(os.path.join(data_dir, "metrics.json")) as fp:
+        run_metrics = json.load(fp)
+
+    return {
+        "wall_time": wall_time,
+        # Kilobytes on Linux
+        "peak_rss": usage.ru_maxrss,
+        "datasets_per_second": run_metrics["datasets"] / wall_time,
+        "bytes_downloaded": run_metrics["bytes_downloaded"],
+        "phases": run_metrics["phases"],
+        "cache_hit_rate": run_metrics["cache_hit_rate"],
+    }
+
+
+def benchmark(args):
+    www_dir = os.path.join(args.work_dir, "www")
+    os.makedirs(www_dir, exist_ok=True)
+
+    server = start_server(
+        www_dir, args.latency, args.bandwidth, args.error_rate, args.seed
+    )
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    registry = generate(
+        args.work_dir, args.datasets, args.sizes, args.formats, base_url
+    )
+    registry_path = os.path.join(args.work_dir, "registry.json")
+    with open(registry_path, "w") as fp:
+        json.dump(registry, fp, indent=4)
+
+    results = []
+    for threads in args.threads:
+        run_dir = os.path.join(args.work_dir, f"threads-{threads}")
+
+        # A cold run starts without a cache, the warm run reuses the cold one's
+        shutil.rmtree(run_dir, ignore_errors=True)
+        os.makedirs(run_dir)
+
+        for cache_state in ["cold", "warm"]:
+            print(f"Running with {threads} threads and a {cache_state} cache")
+            result = run_datagetter(
+                run_dir, registry_path, threads, args.datagetter_args
+            )
+            result.update({"threads": threads, "cache": cache_state})
+            results.append(result)
+
+            print(
+                f"  {result['wall_time']:.1f}s "
+                f"{result['datasets_per_second']:.2f} datasets/s "
+                f"peak RSS {result['peak_rss'] / 1024:.0f}MB"
+            )
+            for phase, stats in result["phases"].items():
+                if stats["count"]:
+                    print(
+                        f"  {phase:<22} sum {stats['sum']:8.2f}s "
+                        f"p50 {stats['p50']:7.3f}s p95 {stats['p95']:7.3f}s"
+                    )
+
+    server.shutdown()
+
+    with open(args.output, "w") as fp:
+        json.dump(
+            {"parameters": vars(args), "results": results}, fp, indent=4, default=str
+        )
+    print(f"Results written to {args.output}")
+
+
+def comma_separated(convert):
+    return lambda value: [convert(item) for item in value.split(",")]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+
+    parser.add_argument(
+        "--datasets",
+        type=int,
+        default=20,
+        help="Number of datasets in the synthetic registry. Defaults to 20",
+    )
+    parser.add_argument(
+        "--sizes",
+        type=comma_separated(int),
+        default=[100, 1000, 10000],
+        help="Grants per dataset, cycled through e.g. 100,1000,10000",
+    )
+    parser.add_argument(
+        "--formats",
+        type=comma_separated(str),
+        default=FORMATS,
+        help="File formats, cycled through. Defaults to json,xlsx,csv,ods",
+    )
+    parser.add_argument(
+        "--threads",
+        type=comma_separated(int),
+        default=[1, 4],
+        help="--threads values to benchmark e.g. 1,4,8",
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0,
+        help="Seconds the publisher server waits before responding",
+    )
+    parser.add_argument(
+        "--bandwidth",
+        type=parse_size,
+        help="Bytes per second the publisher server sends per download e.g. 1M",
+    )
+    parser.add_argument(
+        "--error-rate",
+        type=float,
+        default=0,
+        help="Fraction of requests the publisher server fails with a 500",
+    )
+    parser.add_argument(
+        "--seed", type=int, default=0, help="Seed for the synthetic errors"
+    )
+    parser.add_argument(
+        "--work-dir",
+        default="benchmark_work",
+        help="Where the synthetic files and runs go. Files are reused between benchmarks",
+    )
+    parser.add_argument(
+        "--output", default="benchmark.json", help="File to write the results to"
+    )
+    parser.add_argument(
+        "datagetter_args",
+        nargs="*",
+        help="Further arguments for datagetter.py, after -- e.g. -- --pipeline",
+    )
+
+    args = parser.parse_args()
+
+    unknown_formats = set(args.formats) - set(FORMATS)
+    if unknown_formats:
+        parser.error(f"Unknown formats {', '.join(unknown_formats)}")
+
+    benchmark(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""
+Benchmarks how long the datagetter takes to start, i.e. to import getter.get
+and to run datagetter.py --help, in fresh interpreters.
+
+The conversion and validation libraries are only meant to be imported when a
+file is converted or validated, so this fails if importing getter.get brings
+any of them in, or (with --max-seconds) if starting up takes too long.
+
+e.g.
+$ benchmarks/startup.py --repeat 10 --max-seconds 0.5
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules that should only be imported once there's a file to convert/validate
+HEAVY_MODULES = ["lib360dataquality", "libcove", "flattentool", "openpyxl", "odf"]
+
+COMMANDS = {
+    "import getter.get": [sys.executable, "-c", "import getter.get"],
+    "datagetter.py --help": [
+        sys.executable,
+        os.path.join(REPO_DIR, "datagetter.py"),
+        "--help",
+    ],
+    # For comparison, what importing them up front would cost
+    "import heavy modules": [
+        sys.executable,
+        "-c",
+        "import lib360dataquality.cove.threesixtygiving, libcove.lib.converters",
+    ],
+}
+
+
+def time_command(command, repeat):
+    """Returns the wall time of each of repeat runs of command, or None if it fails"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = subprocess.run(command, cwd=REPO_DIR, capture_output=True)
+        times.append(time.perf_counter() - start)
+
+        if result.returncode != 0:
+            return None
+
+    return times
+
+
+def heavy_modules_imported():
+    """Returns the HEAVY_MODULES that importing getter.get imports"""
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import getter.get, json, sys; "
+            "print(json.dumps(sorted({name.split('.')[0] for name in sys.modules})))",
+        ],
+        cwd=REPO_DIR,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return sorted(set(json.loads(result.stdout)) & set(HEAVY_MODULES))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=5,
+        help="Number of times each command is run. Defaults to 5",
+    )
+    parser.add_argument(
+        "--max-seconds",
+        type=float,
+        help="Fail if the median time to import getter.get is longer than this",
+    )
+    parser.add_argument("--output", help="File to write the results to as JSON")
+
+    args = parser.parse_args()
+
+    results = {}
+    for name, command in COMMANDS.items():
+        times = time_command(command, args.repeat)
+        if times is None:
+            print(f"{name:<22} failed")
+            continue
+
+        results[name] = {
+            "median": statistics.median(times),
+            "min": min(times),
+            "max": max(times),
+        }
+        print(
+            f"{name:<22} median {results[name]['median']:.3f}s "
+            f"min {results[name]['min']:.3f}s max {results[name]['max']:.3f}s"
+        )
+
+    imported = heavy_modules_imported()
+
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump({"results": results, "heavy_modules": imported}, fp, indent=4)
+
+    failed = False
+    if imported:
+        print(f"Importing getter.get imports {', '.join(imported)}")
+        failed = True
+
+    median = results.get("import getter.get", {}).get("median")
+    if args.max_seconds and (median is None or median > args.max_seconds):
+        print(f"Importing getter.get takes longer than {args.max_seconds}s")
+        failed = True
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
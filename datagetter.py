@@ -1,6 +1,59 @@
 #!/usr/bin/env python3
-from getter.get import get
+from getter.get import get, merge
+import getter.cache as cache
+import getter.compression as compression
+import getter.schema_store as schema_store
+import getter.shard as shard
 import argparse
+import json
+import os
+
+SIZE_SUFFIXES = {"K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+
+
+def parse_size(size):
+    """Parses a number of bytes with an optional K, M, G or T suffix"""
+    multiplier = SIZE_SUFFIXES.get(size[-1:].upper())
+    if multiplier:
+        return int(float(size[:-1]) * multiplier)
+    return int(size)
+
+
+def days(value):
+    return float(value) * 24 * 60 * 60
+
+
+def shard_spec(value):
+    """Parses INDEX/COUNT e.g. 0/4 for the first of four shards"""
+    try:
+        index, count = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"{value} isn't INDEX/COUNT e.g. 0/4")
+
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f"{value} needs 0 <= INDEX < COUNT")
+
+    return index, count
+
+
+def cache_command(args):
+    try:
+        # Keep the algorithm the cache is keyed with, rather than rekeying it
+        cache.setup_database()
+        if args.action == "stats":
+            result = cache.stats()
+        elif args.action == "gc":
+            result = cache.gc(args.cache_max_bytes, args.cache_max_age)
+        elif args.action == "verify":
+            result = cache.verify()
+    except cache.DatagetterCacheError as e:
+        print(e)
+        exit(1)
+
+    print(json.dumps(result, indent=4))
+
+    if args.action == "verify" and result:
+        exit(1)
 
 
 def main():
@@ -42,6 +95,13 @@ def main():
         default="main",
     )
 
+    parser.add_argument(
+        "--offline",
+        dest="offline",
+        action="store_true",
+        help="Use the schemas stored by a previous run rather than checking GitHub for changes",
+    )
+
     parser.add_argument(
         "--publishers",
         nargs="+",
@@ -51,9 +111,281 @@ def main():
         help="Only download for selected publishers",
     )
 
+    parser.add_argument(
+        "--shard",
+        dest="shard",
+        action="store",
+        type=shard_spec,
+        help="Only process this shard of the registry e.g. 0/4 for the first of four. Shard each run into its own "
+        "data dir and combine them with the merge command",
+    )
+
+    parser.add_argument(
+        "--shard-weights",
+        dest="shard_weights",
+        action="store",
+        help="Balance the shards by the file sizes in this data_all.json of a previous run, rather than by "
+        "identifier. Every shard needs the same registry and weights, e.g. with --local-registry",
+    )
+
+    parser.add_argument(
+        "--pipeline",
+        dest="pipeline",
+        action="store_true",
+        help="Download in threads and convert/validate in a separate pool of processes",
+    )
+
+    parser.add_argument(
+        "--download-concurrency",
+        dest="download_concurrency",
+        action="store",
+        type=int,
+        default=16,
+        help="Number of simultaneous downloads in pipeline mode. Defaults to 16",
+    )
+
+    parser.add_argument(
+        "--workers",
+        dest="workers",
+        action="store",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of conversion/validation processes in pipeline mode. Defaults to the number of CPUs",
+    )
+
+    parser.add_argument(
+        "--host-concurrency",
+        dest="host_concurrency",
+        action="store",
+        type=int,
+        default=4,
+        help="Maximum simultaneous downloads from one host, 0 for no limit. Defaults to 4",
+    )
+
+    parser.add_argument(
+        "--max-tasks-per-child",
+        dest="max_tasks_per_child",
+        action="store",
+        type=int,
+        help="Replace each conversion/validation process with a fresh one after it has processed this many "
+        "datasets",
+    )
+
+    parser.add_argument(
+        "--worker-max-rss",
+        dest="worker_max_rss",
+        action="store",
+        type=parse_size,
+        help="Replace a conversion/validation process with a fresh one after a dataset leaves it using more "
+        "than this much memory e.g. 2G",
+    )
+
+    parser.add_argument(
+        "--large-file-size",
+        dest="large_file_size",
+        action="store",
+        type=parse_size,
+        help="Convert and validate downloads larger than this e.g. 50M in a separate pool of "
+        "--large-file-workers processes, so that only that many are in memory at once",
+    )
+
+    parser.add_argument(
+        "--large-file-workers",
+        dest="large_file_workers",
+        action="store",
+        type=int,
+        default=1,
+        help="Number of processes converting and validating downloads over --large-file-size. Defaults to 1",
+    )
+
+    parser.add_argument(
+        "--validation-chunk-size",
+        dest="validation_chunk_size",
+        action="store",
+        type=int,
+        help="Validate files with more grants than this in chunks of this many grants, in parallel "
+        "in a pool of --validation-workers processes",
+    )
+
+    parser.add_argument(
+        "--validation-workers",
+        dest="validation_workers",
+        action="store",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of processes validating chunks with --validation-chunk-size. Defaults to the number of CPUs",
+    )
+
+    parser.add_argument(
+        "--schedule",
+        dest="schedule",
+        choices=["size", "registry"],
+        default="size",
+        help="Order to process the datasets in. size (the default) starts those expected to take longest first, "
+        "going by previous runs (see --head-sizes), and those with nothing to go on before them. registry keeps "
+        "the registry's order",
+    )
+
+    parser.add_argument(
+        "--head-sizes",
+        dest="head_sizes",
+        action="store_true",
+        help="For --schedule size, make a HEAD request for the size of each dataset there's no previous run's "
+        "time or size for, before starting",
+    )
+
+    parser.add_argument(
+        "--head-concurrency",
+        dest="head_concurrency",
+        action="store",
+        type=int,
+        default=16,
+        help="Number of simultaneous HEAD requests for --head-sizes, within --host-concurrency. Defaults to 16",
+    )
+
+    parser.add_argument(
+        "--incremental",
+        dest="incremental",
+        action="store_true",
+        help="Make conditional requests and reuse the previous results for unmodified files",
+    )
+
+    parser.add_argument(
+        "--registry-diff",
+        dest="registry_diff",
+        action="store_true",
+        help="Only process the datasets that are new to the registry, or whose download URL, license or modified "
+        "date has changed, since the previous run in the data dir. The rest keep that run's results. "
+        "Writes the changes to registry_diff.json",
+    )
+
+    parser.add_argument(
+        "--resume",
+        dest="resume",
+        action="store_true",
+        help="Carry on an interrupted run in the existing data dir, only processing the datasets it didn't finish",
+    )
+
+    parser.add_argument(
+        "--compress",
+        dest="compress",
+        choices=["gzip", "zstd"],
+        help="Compress the originals and JSON in the data dir and cache, adding .gz or .zst to their names. "
+        "zstd needs the zstandard package. Read them with getter.compression.open_file",
+    )
+
+    parser.add_argument(
+        "--grants-ndjson",
+        dest="grants_ndjson",
+        action="store_true",
+        help="Also write grants_all.ndjson and a grants_<name>.ndjson for each json_<name> dir, with one grant "
+        "per line tagged with its dataset identifier and publisher prefix",
+    )
+
+    parser.add_argument(
+        "--grants-index",
+        dest="grants_index",
+        action="store_true",
+        help="Also write grants_index.db, an SQLite database of each grant's id, dataset, recipient and funder "
+        "org ids, amount and award date",
+    )
+
+    parser.add_argument(
+        "--hash-algorithm",
+        dest="hash_algorithm",
+        choices=list(cache.HASH_ALGORITHMS),
+        help="Hash the files' content with this to key the cache. Defaults to the algorithm the cache is "
+        "already keyed with, or blake2b for a new cache. xxh3_128 needs the xxhash package. A cache keyed with "
+        "another algorithm is rekeyed, dropping what can't be rehashed",
+    )
+
+    parser.add_argument(
+        "--cache-max-bytes",
+        dest="cache_max_bytes",
+        action="store",
+        type=parse_size,
+        help="After the run evict least recently used cache entries beyond this size (including the cache "
+        "database) e.g. 20G",
+    )
+
+    parser.add_argument(
+        "--cache-max-age",
+        dest="cache_max_age",
+        action="store",
+        type=days,
+        help="After the run evict cache entries not used for this many days",
+    )
+
+    parser.add_argument(
+        "--metrics-prometheus",
+        dest="metrics_prometheus",
+        action="store",
+        help="Also write the run's metrics (see metrics.json in the data dir) to this file in "
+        "the Prometheus textfile collector format",
+    )
+
+    subparsers = parser.add_subparsers(dest="command")
+
+    cache_parser = subparsers.add_parser("cache", help="Maintain the cache")
+    cache_parser.add_argument(
+        "action",
+        choices=["stats", "gc", "verify"],
+        help="stats: summarise the cache. gc: remove orphaned and evicted entries. "
+        "verify: check the cached files",
+    )
+    cache_parser.add_argument(
+        "--max-bytes",
+        dest="cache_max_bytes",
+        action="store",
+        type=parse_size,
+        help="gc: Evict least recently used entries beyond this size (including the cache database) e.g. 20G",
+    )
+    cache_parser.add_argument(
+        "--max-age",
+        dest="cache_max_age",
+        action="store",
+        type=days,
+        help="gc: Evict entries not used for this many days",
+    )
+
+    merge_parser = subparsers.add_parser(
+        "merge", help="Combine the data dirs of a sharded run into --data-dir"
+    )
+    merge_parser.add_argument(
+        "shard_dirs", nargs="+", help="The data dirs of the shards"
+    )
+
     args = parser.parse_args()
 
-    get(args)
+    if args.command != "cache" and args.compress:
+        try:
+            compression.check_available(args.compress)
+        except ImportError as e:
+            parser.error(str(e))
+
+    if args.hash_algorithm:
+        try:
+            cache.check_hash_algorithm(args.hash_algorithm)
+        except ImportError as e:
+            parser.error(str(e))
+
+    if args.validation_chunk_size is not None and args.validation_chunk_size < 1:
+        parser.error("--validation-chunk-size must be at least 1")
+
+    if args.command == "cache":
+        cache_command(args)
+    elif args.command == "merge":
+        try:
+            merge(args)
+        except shard.ShardError as e:
+            print(e)
+            exit(1)
+    else:
+        try:
+            get(args)
+        except (schema_store.SchemaStoreError, shard.ShardError) as e:
+            print(e)
+            exit(1)
 
 
 if __name__ == "__main__":
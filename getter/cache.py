@@ -1,68 +1,403 @@
 import os
+import json
 import shutil
+import threading
+import time
 import apsw
 import hashlib
 
+import getter.compression as compression
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
 DATABASE_NAME = "cache_datagetter.db"
 CACHE_DIR = "cache_dir"
 DATABASE_FILE = os.path.abspath(DATABASE_NAME)
 
 
+# Milliseconds to wait for another worker's write to finish
+BUSY_TIMEOUT = 30000
+
+# Bumped when the tables change in a way that needs setup_database to migrate
+SCHEMA_VERSION = 5
+
+# Hash objects for keying the cache by file content, by algorithm name
+HASH_ALGORITHMS = {
+    "blake2b": lambda: hashlib.blake2b(digest_size=32),
+    "sha1": hashlib.sha1,
+    "xxh3_128": lambda: xxhash.xxh3_128(),
+}
+DEFAULT_HASH_ALGORITHM = "blake2b"
+
+# Bytes hashed at a time when hashing a file
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# The algorithm the cache is keyed with, see current_hash_algorithm()
+hash_algorithm = None
+
+# Each process (and thread) keeps its database connection open between calls
+local = threading.local()
+
+
 class DatagetterCacheError(Exception):
     pass
 
 
-def setup_database():
-    try:
+def connect():
+    """Returns this process and thread's connection to the cache database"""
+    con = getattr(local, "connection", None)
+
+    if con is None or local.pid != os.getpid():
         con = apsw.Connection(DATABASE_NAME)
+        con.setbusytimeout(BUSY_TIMEOUT)
+        con.cursor().execute("PRAGMA synchronous = NORMAL")
+        local.connection = con
+        local.pid = os.getpid()
+
+    return con
+
+
+def close():
+    con = getattr(local, "connection", None)
+    if con is not None and local.pid == os.getpid():
+        con.close()
+    local.connection = None
+
+
+def check_hash_algorithm(algorithm):
+    if algorithm not in HASH_ALGORITHMS:
+        raise ValueError(f"Unknown hash algorithm {algorithm}")
+    if algorithm == "xxh3_128" and not xxhash:
+        raise ImportError("xxh3_128 hashing needs the xxhash package installed")
+
+
+def setup_database(algorithm=None):
+    """
+    Creates or migrates the database. If algorithm is given and the cache was
+    keyed with another hash algorithm it's rekeyed (see migrate_hashes),
+    otherwise it keeps the algorithm it was keyed with (or the default for a
+    new cache).
+    """
+    global hash_algorithm
+
+    try:
+        con = connect()
         cur = con.cursor()
+        # Lets workers read while another writes
+        cur.execute("PRAGMA journal_mode = WAL")
+
+        version = cur.execute("PRAGMA user_version").fetchall()[0][0]
+
+        # Before the tables were versioned the conversions were stored by
+        # dataset identifier (see migrate_identifier_cache)
+        tables = [
+            row[0]
+            for row in cur.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table'"
+            )
+        ]
+        by_identifier = version < 1 and "cache" in tables
+
+        with con:
+            if by_identifier:
+                cur.execute("ALTER TABLE cache RENAME TO cache_by_identifier")
+
+            cur.execute(
+                """CREATE TABLE IF NOT EXISTS cache
+                (hash TEXT NOT NULL PRIMARY KEY,
+                original_file_name TEXT NOT NULL,
+                json_file TEXT NOT NULL,
+                accessed REAL NOT NULL DEFAULT 0);"""
+            )
+
+            if by_identifier:
+                migrate_identifier_cache(cur)
+
         cur.execute(
-            """CREATE TABLE IF NOT EXISTS cache
-            (original_file_name TEXT NOT NULL UNIQUE,
-            hash TEXT NOT NULL UNIQUE,
-            json_file TEXT NOT NULL UNIQUE);"""
+            """CREATE TABLE IF NOT EXISTS http_validators
+            (url TEXT NOT NULL PRIMARY KEY,
+            etag TEXT,
+            last_modified TEXT,
+            hash TEXT NOT NULL,
+            file_type TEXT NOT NULL,
+            schema_branch TEXT NOT NULL,
+            schema_hash TEXT,
+            converted INTEGER NOT NULL,
+            metadata TEXT NOT NULL,
+            accessed REAL NOT NULL DEFAULT 0);"""
         )
-        con.close()
+        cur.execute(
+            """CREATE TABLE IF NOT EXISTS validation
+            (hash TEXT NOT NULL,
+            schema_hash TEXT NOT NULL,
+            errors_count INTEGER NOT NULL,
+            errors TEXT NOT NULL,
+            accessed REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (hash, schema_hash));"""
+        )
+        # The extensions used to be keyed by identifier, so only had those of
+        # each dataset's latest file
+        columns = list(cur.execute("PRAGMA table_info(extensions)"))
+        keyed_by_identifier = [column[1] for column in columns if column[5]] == [
+            "identifier"
+        ]
+        with con:
+            if keyed_by_identifier:
+                cur.execute("ALTER TABLE extensions RENAME TO extensions_by_identifier")
+
+            cur.execute(
+                """CREATE TABLE IF NOT EXISTS extensions
+                (hash TEXT NOT NULL PRIMARY KEY,
+                identifier TEXT NOT NULL,
+                extensions TEXT NOT NULL,
+                updated REAL NOT NULL DEFAULT 0);"""
+            )
+            cur.execute(
+                "CREATE INDEX IF NOT EXISTS extensions_identifier ON extensions (identifier)"
+            )
+
+            if keyed_by_identifier:
+                cur.execute(
+                    """INSERT OR REPLACE INTO extensions (hash, identifier, extensions)
+                    SELECT hash, identifier, extensions FROM extensions_by_identifier"""
+                )
+                cur.execute("DROP TABLE extensions_by_identifier")
+
+        cur.execute(
+            """CREATE TABLE IF NOT EXISTS history
+            (identifier TEXT NOT NULL PRIMARY KEY,
+            file_type TEXT,
+            file_size INTEGER,
+            seconds REAL NOT NULL,
+            accessed REAL NOT NULL DEFAULT 0);"""
+        )
+
+        # Access times for evicting the least recently used entries
+        for table in ["cache", "http_validators", "validation", "history"]:
+            columns = list(cur.execute(f"PRAGMA table_info({table})"))
+            if "accessed" not in [column[1] for column in columns]:
+                cur.execute(
+                    f"ALTER TABLE {table} ADD COLUMN accessed REAL NOT NULL DEFAULT 0"
+                )
+
+        if version < 4:
+            # Validators recorded without the schemas' hash are never used
+            columns = list(cur.execute("PRAGMA table_info(http_validators)"))
+            if "schema_hash" not in [column[1] for column in columns]:
+                cur.execute("ALTER TABLE http_validators ADD COLUMN schema_hash TEXT")
+
+        cur.execute(
+            """CREATE TABLE IF NOT EXISTS settings
+            (key TEXT NOT NULL PRIMARY KEY,
+            value TEXT NOT NULL);"""
+        )
+        row = cur.execute(
+            "SELECT value FROM settings WHERE key = 'hash_algorithm'"
+        ).fetchone()
+        if row:
+            previous_algorithm = row[0]
+        elif by_identifier or 0 < version < 3:
+            # Before the algorithm was recorded it was always SHA-1
+            previous_algorithm = "sha1"
+        else:
+            previous_algorithm = algorithm or DEFAULT_HASH_ALGORITHM
+
+        algorithm = algorithm or previous_algorithm
+        hash_algorithm = algorithm
+
+        if previous_algorithm != algorithm:
+            with con:
+                migrate_hashes(cur, previous_algorithm, algorithm)
+                cur.execute(
+                    "INSERT OR REPLACE INTO settings VALUES ('hash_algorithm', ?)",
+                    (algorithm,),
+                )
+        elif not row:
+            cur.execute(
+                "INSERT INTO settings VALUES ('hash_algorithm', ?)", (algorithm,)
+            )
+
+        cur.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
     except Exception as e:
         raise DatagetterCacheError(e)
 
 
 def setup_cache_dir():
     try:
-        os.makedirs(CACHE_DIR, exist_ok=True)
+        os.makedirs(os.path.join(CACHE_DIR, "json"), exist_ok=True)
+        os.makedirs(os.path.join(CACHE_DIR, "original"), exist_ok=True)
     except Exception as e:
         raise DatagetterCacheError(e)
 
 
-def hash_file(original_file_path):
+def link_file(src, dst):
+    """
+    Hardlinks src to dst rather than copying it, falling back to a copy where
+    that's not possible (e.g. across filesystems). An existing dst is replaced,
+    not written to, as it may be linked to other files.
+    """
+    tmp_dst = f"{dst}.{os.getpid()}.{threading.get_ident()}.tmp"
     try:
-        file_hash = hashlib.sha1()
+        os.link(src, tmp_dst)
+    except OSError:
+        shutil.copy(src, tmp_dst)
+    os.replace(tmp_dst, dst)
+
+
+def current_hash_algorithm():
+    """
+    Returns the algorithm the cache is keyed with. That's set by
+    setup_database(), or read from the database in processes that didn't call
+    it (e.g. pool workers started by a forkserver).
+    """
+    global hash_algorithm
 
-        with open(original_file_path, "rb") as fp:
-            while True:
-                data = fp.read(6000)
-                if not data:
-                    break
+    if hash_algorithm is None:
+        try:
+            row = (
+                connect()
+                .cursor()
+                .execute("SELECT value FROM settings WHERE key = 'hash_algorithm'")
+                .fetchone()
+            )
+        except Exception:
+            row = None
+        hash_algorithm = row[0] if row else DEFAULT_HASH_ALGORITHM
 
-                file_hash.update(data)
+    return hash_algorithm
+
+
+def new_hash(algorithm=None):
+    """Returns the hash object used to key the cache, for hashing incrementally"""
+    return HASH_ALGORITHMS[algorithm or current_hash_algorithm()]()
+
+
+def hash_file(original_file_path, algorithm=None):
+    """Hashes a file's content, decompressed if it's compressed"""
+    try:
+        file_hash = new_hash(algorithm)
+        buffer = bytearray(HASH_CHUNK_SIZE)
+        view = memoryview(buffer)
+
+        with compression.open_file(original_file_path) as fp:
+            while size := fp.readinto(buffer):
+                file_hash.update(view[:size])
     except Exception as e:
         raise DatagetterCacheError(e)
 
     return file_hash.hexdigest()
 
 
+def migrate_identifier_cache(cur):
+    """
+    Moves the conversions of a cache from before the tables were versioned
+    from CACHE_DIR/<identifier>.json to json/<hash>.json, and from the
+    cache_by_identifier table to the cache table. Each row's hash is that of
+    the file its identifier's JSON was last converted from, as the two were
+    always updated together.
+    """
+    print("Moving the cached conversions to be stored by hash")
+    os.makedirs(os.path.join(CACHE_DIR, "json"), exist_ok=True)
+
+    for original_file_name, file_hash_str, json_file in list(
+        cur.execute(
+            "SELECT original_file_name, hash, json_file FROM cache_by_identifier"
+        )
+    ):
+        old_path = os.path.join(CACHE_DIR, json_file)
+        if not os.path.exists(old_path):
+            continue
+
+        new_json_file = os.path.join("json", f"{file_hash_str}.json")
+        os.replace(old_path, os.path.join(CACHE_DIR, new_json_file))
+        cur.execute(
+            """INSERT OR REPLACE INTO cache
+            (hash, original_file_name, json_file, accessed)
+            VALUES (?, ?, ?, ?)""",
+            (file_hash_str, original_file_name, new_json_file, time.time()),
+        )
+
+    cur.execute("DROP TABLE cache_by_identifier")
+
+
+def migrate_hashes(cur, previous_algorithm, algorithm):
+    """
+    Rekeys the cache from hashes by previous_algorithm to hashes by algorithm.
+    The originals kept in CACHE_DIR (for each conversion and each set of HTTP
+    validators) are rehashed, as are the stored schemas the HTTP validators and
+    validations were recorded against. Entries without an original or schemas
+    to rehash are dropped.
+    """
+    # Imported here as it imports this module
+    from getter.schema_store import schema_hash_changes
+
+    print(f"Rekeying the cache from {previous_algorithm} to {algorithm} hashes")
+    new_hashes = {}
+
+    original_dir = os.path.join(CACHE_DIR, "original")
+    for file_name in os.listdir(original_dir) if os.path.isdir(original_dir) else []:
+        # <hash>.<file type>, plus the suffix if it's compressed
+        old_hash, _, extension = file_name.partition(".")
+        path = os.path.join(original_dir, file_name)
+
+        new_hashes[old_hash] = hash_file(path, algorithm)
+        os.replace(
+            path, os.path.join(original_dir, f"{new_hashes[old_hash]}.{extension}")
+        )
+
+    for old_hash, json_file in list(cur.execute("SELECT hash, json_file FROM cache")):
+        old_path = os.path.join(CACHE_DIR, json_file)
+        if old_hash not in new_hashes:
+            cur.execute("DELETE FROM cache WHERE hash = ?", (old_hash,))
+            if os.path.exists(old_path):
+                os.unlink(old_path)
+            continue
+
+        new_json_file = json_file.replace(old_hash, new_hashes[old_hash], 1)
+        if os.path.exists(old_path):
+            os.replace(old_path, os.path.join(CACHE_DIR, new_json_file))
+        cur.execute(
+            "UPDATE cache SET hash = ?, json_file = ? WHERE hash = ?",
+            (new_hashes[old_hash], new_json_file, old_hash),
+        )
+
+    new_schema_hashes = schema_hash_changes(previous_algorithm, algorithm)
+    rekeyed_columns = [
+        ("http_validators", "hash", new_hashes),
+        ("http_validators", "schema_hash", new_schema_hashes),
+        ("extensions", "hash", new_hashes),
+        ("validation", "hash", new_hashes),
+        ("validation", "schema_hash", new_schema_hashes),
+    ]
+    for table, column, new_column_hashes in rekeyed_columns:
+        for (old_hash,) in list(cur.execute(f"SELECT DISTINCT {column} FROM {table}")):
+            if old_hash in new_column_hashes:
+                cur.execute(
+                    f"UPDATE {table} SET {column} = ? WHERE {column} = ?",
+                    (new_column_hashes[old_hash], old_hash),
+                )
+            else:
+                cur.execute(f"DELETE FROM {table} WHERE {column} IS ?", (old_hash,))
+
+
 def get_file(file_hash_str):
     try:
-        con = apsw.Connection(DATABASE_NAME)
+        con = connect()
         cur = con.cursor()
         cur.execute("SELECT json_file FROM cache WHERE hash = ?", (file_hash_str,))
         row = cur.fetchone()
-        con.close()
 
         # We haven't already converted the file
         if not row:
             return False
 
+        cur.execute(
+            "UPDATE cache SET accessed = ? WHERE hash = ?", (time.time(), file_hash_str)
+        )
+
         # We have converted the file before so copy from the CACHE_DIR
         return os.path.join(CACHE_DIR, row[0])
     except Exception as e:
@@ -71,41 +406,544 @@ def get_file(file_hash_str):
 
 def update_cache(json_file_name, file_hash_str, file_identifier, file_type):
     """
-    Updates the cache database and copies the data into the cache dir
+    Updates the cache database and links the data into the cache dir, where
+    it's stored by the hash of the file it was converted from
     json_file_name: Output desination for the file
     """
-    # Todo clean up cache functionality for orphaned files or to reset the cache
-
     try:
-        con = apsw.Connection(DATABASE_NAME)
+        cached_json_file = os.path.join(
+            "json", f"{file_hash_str}.json{compression.suffix_of(json_file_name)}"
+        )
+        link_file(json_file_name, os.path.join(CACHE_DIR, cached_json_file))
+
+        con = connect()
         cur = con.cursor()
 
         cur.execute(
             """
-        INSERT INTO cache (original_file_name, hash, json_file)
-        VALUES (?, ?, ?)
-        ON CONFLICT(original_file_name) DO UPDATE SET hash=?
-        ON CONFLICT(json_file) DO UPDATE SET hash=?, original_file_name=?
+        INSERT OR REPLACE INTO cache (hash, original_file_name, json_file, accessed)
+        VALUES (?, ?, ?, ?)
         """,
             (
+                file_hash_str,
                 file_identifier + "." + file_type,
+                cached_json_file,
+                time.time(),
+            ),
+        )
+    except Exception as e:
+        raise DatagetterCacheError(e)
+
+
+def get_validators(url, schema_branch, schema_hash_str):
+    """
+    Returns the HTTP validators and result recorded for url by a previous run
+    against the same schema branch and schemas (by their hash), or None
+    """
+    try:
+        con = connect()
+        cur = con.cursor()
+        cur.execute(
+            """SELECT etag, last_modified, hash, file_type, converted, metadata
+            FROM http_validators
+            WHERE url = ? AND schema_branch = ? AND schema_hash = ?""",
+            (url, schema_branch, schema_hash_str),
+        )
+        row = cur.fetchone()
+
+        if not row:
+            return None
+
+        cur.execute(
+            "UPDATE http_validators SET accessed = ? WHERE url = ?", (time.time(), url)
+        )
+
+        return {
+            "etag": row[0],
+            "last_modified": row[1],
+            "hash": row[2],
+            "file_type": row[3],
+            "converted": bool(row[4]),
+            "metadata": json.loads(row[5]),
+        }
+    except Exception as e:
+        raise DatagetterCacheError(e)
+
+
+def update_validators(
+    url,
+    etag,
+    last_modified,
+    file_hash_str,
+    file_type,
+    schema_branch,
+    schema_hash_str,
+    converted,
+    metadata,
+):
+    """
+    Records the HTTP validators of a download alongside the outcome of
+    processing it so that an unmodified download can be skipped next run
+    """
+    try:
+        con = connect()
+        cur = con.cursor()
+        cur.execute(
+            """
+        INSERT OR REPLACE INTO http_validators
+        (url, etag, last_modified, hash, file_type, schema_branch, schema_hash,
+        converted, metadata, accessed)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+            (
+                url,
+                etag,
+                last_modified,
                 file_hash_str,
-                file_identifier + ".json",
+                file_type,
+                schema_branch,
+                schema_hash_str,
+                int(converted),
+                json.dumps(metadata),
+                time.time(),
+            ),
+        )
+    except Exception as e:
+        raise DatagetterCacheError(e)
+
+
+def store_original(original_file_path, file_hash_str, file_type):
+    """Keeps a downloaded original (by hash) so it can be restored on a 304"""
+    try:
+        cached_path = os.path.join(
+            CACHE_DIR, "original", f"{file_hash_str}.{file_type}"
+        )
+        if not compression.find(cached_path):
+            link_file(
+                original_file_path,
+                cached_path + compression.suffix_of(original_file_path),
+            )
+    except Exception as e:
+        raise DatagetterCacheError(e)
+
+
+def get_original(file_hash_str, file_type):
+    """Returns the path of the kept original, which may be compressed, or False"""
+    cached_path = os.path.join(CACHE_DIR, "original", f"{file_hash_str}.{file_type}")
+    return compression.find(cached_path) or False
+
+
+def get_validation(file_hash_str, schema_hash_str):
+    """
+    Returns the (errors_count, errors) from validating the file content against
+    the schemas before, or None
+    """
+    try:
+        con = connect()
+        cur = con.cursor()
+        cur.execute(
+            "SELECT errors_count, errors FROM validation WHERE hash = ? AND schema_hash = ?",
+            (file_hash_str, schema_hash_str),
+        )
+        row = cur.fetchone()
+
+        if not row:
+            return None
+
+        cur.execute(
+            "UPDATE validation SET accessed = ? WHERE hash = ? AND schema_hash = ?",
+            (time.time(), file_hash_str, schema_hash_str),
+        )
+
+        return row[0], json.loads(row[1])
+    except Exception as e:
+        raise DatagetterCacheError(e)
+
+
+def update_validation(file_hash_str, schema_hash_str, errors_count, errors):
+    try:
+        con = connect()
+        cur = con.cursor()
+        cur.execute(
+            """
+        INSERT OR REPLACE INTO validation
+        (hash, schema_hash, errors_count, errors, accessed)
+        VALUES (?, ?, ?, ?, ?)
+        """,
+            (
                 file_hash_str,
+                schema_hash_str,
+                errors_count,
+                json.dumps(errors, default=str),
+                time.time(),
+            ),
+        )
+    except Exception as e:
+        raise DatagetterCacheError(e)
+
+
+def get_extensions(file_hash_str, file_identifier):
+    """
+    Returns the schema extensions declared by the file when it was converted,
+    or by the last file converted for the identifier, or None
+    """
+    try:
+        con = connect()
+        cur = con.cursor()
+        rows = cur.execute(
+            "SELECT extensions FROM extensions WHERE hash = ?", (file_hash_str,)
+        ).fetchall()
+
+        if not rows:
+            rows = cur.execute(
+                """SELECT extensions FROM extensions WHERE identifier = ?
+                ORDER BY updated DESC LIMIT 1""",
+                (file_identifier,),
+            ).fetchall()
+
+        if not rows:
+            return None
+
+        return json.loads(rows[0][0])
+    except Exception as e:
+        raise DatagetterCacheError(e)
+
+
+def update_extensions(file_hash_str, file_identifier, extensions):
+    try:
+        con = connect()
+        cur = con.cursor()
+        cur.execute(
+            """INSERT OR REPLACE INTO extensions (hash, identifier, extensions, updated)
+            VALUES (?, ?, ?, ?)""",
+            (
                 file_hash_str,
-                file_identifier + "." + file_type,
+                file_identifier,
+                json.dumps(extensions, default=str),
+                time.time(),
             ),
         )
+    except Exception as e:
+        raise DatagetterCacheError(e)
+
+
+def get_history():
+    """
+    Returns how long each dataset took to process last time, as a dict of
+    identifier to (file_type, file_size, seconds)
+    """
+    try:
+        con = connect()
+        cur = con.cursor()
+        return {
+            identifier: (file_type, file_size, seconds)
+            for identifier, file_type, file_size, seconds in cur.execute(
+                "SELECT identifier, file_type, file_size, seconds FROM history"
+            )
+        }
+    except Exception as e:
+        raise DatagetterCacheError(e)
+
 
-        shutil.copy(json_file_name, CACHE_DIR)
+def update_history(history):
+    """
+    Records how long datasets took to process. history is a list of
+    (identifier, file_type, file_size, seconds). The previous file type and
+    size are kept where they're None (e.g. the file wasn't modified).
+    """
+    try:
+        con = connect()
+        with con:
+            now = time.time()
+            con.cursor().executemany(
+                """INSERT INTO history (identifier, file_type, file_size, seconds, accessed)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (identifier) DO UPDATE SET
+                file_type = COALESCE(excluded.file_type, file_type),
+                file_size = COALESCE(excluded.file_size, file_size),
+                seconds = excluded.seconds,
+                accessed = excluded.accessed""",
+                [row + (now,) for row in history],
+            )
+    except Exception as e:
+        raise DatagetterCacheError(e)
+
+
+def cache_entries():
+    """
+    Returns the files in CACHE_DIR that the database refers to, as a dict of
+    path to the most recent access time and the rows referring to it
+    """
+    con = connect()
+    cur = con.cursor()
+    entries = {}
+
+    def add_entry(path, accessed, row):
+        entry = entries.setdefault(path, {"accessed": 0, "rows": []})
+        entry["accessed"] = max(entry["accessed"], accessed)
+        entry["rows"].append(row)
+
+    for file_hash_str, original_file_name, json_file, accessed in list(
+        cur.execute("SELECT hash, original_file_name, json_file, accessed FROM cache")
+    ):
+        path = os.path.join(CACHE_DIR, json_file)
+        add_entry(path, accessed, ("cache", "hash", file_hash_str))
+
+        # The original it was converted from, if it was kept
+        file_type = original_file_name.rsplit(".", 1)[-1]
+        original_path = get_original(file_hash_str, file_type)
+        if original_path:
+            add_entry(original_path, accessed, ("cache", "hash", file_hash_str))
+
+    for url, file_hash_str, file_type, accessed in list(
+        cur.execute("SELECT url, hash, file_type, accessed FROM http_validators")
+    ):
+        path = get_original(file_hash_str, file_type) or os.path.join(
+            CACHE_DIR, "original", f"{file_hash_str}.{file_type}"
+        )
+        add_entry(path, accessed, ("http_validators", "url", url))
+
+    return entries
+
+
+def cache_files():
+    """Returns the paths of all the files in CACHE_DIR"""
+    paths = []
+    for dir_path, _, file_names in os.walk(CACHE_DIR):
+        paths.extend(os.path.join(dir_path, file_name) for file_name in file_names)
+
+    return paths
+
+
+def file_size(path):
+    try:
+        return os.path.getsize(path)
+    except FileNotFoundError:
+        return 0
+
+
+def remove_entry(path, entry):
+    cur = connect().cursor()
+    for table, key_column, key in entry["rows"]:
+        cur.execute(f"DELETE FROM {table} WHERE {key_column} = ?", (key,))
+
+    if os.path.exists(path):
+        os.unlink(path)
+
+
+def stats():
+    """Returns a summary of the cache's contents"""
+    try:
+        cur = connect().cursor()
+        entries = cache_entries()
+        orphans = set(cache_files()) - set(entries)
+        accessed = [entry["accessed"] for entry in entries.values()]
+
+        def count_rows(table):
+            # Fetching all the rows finishes the statement, which would
+            # otherwise keep this connection reading an old snapshot
+            return cur.execute(f"SELECT COUNT(*) FROM {table}").fetchall()[0][0]
+
+        return {
+            "hash_algorithm": current_hash_algorithm(),
+            "conversions": count_rows("cache"),
+            "originals": count_rows("http_validators"),
+            "validations": count_rows("validation"),
+            "extensions": count_rows("extensions"),
+            "files": len(entries),
+            "bytes": sum(file_size(path) for path in entries),
+            "orphaned_files": len(orphans),
+            "orphaned_bytes": sum(file_size(path) for path in orphans),
+            "missing_files": sum(not os.path.exists(path) for path in entries),
+            "database_bytes": database_size(),
+            "least_recently_accessed": min(accessed, default=None),
+            "most_recently_accessed": max(accessed, default=None),
+        }
+    except Exception as e:
+        raise DatagetterCacheError(e)
+
+
+def validation_entries():
+    """
+    Returns the cached validations, as a dict of their key to the most recent
+    access time and the bytes of errors they hold
+    """
+    cur = connect().cursor()
+    return {
+        (file_hash_str, schema_hash_str): {"accessed": accessed, "bytes": size}
+        for file_hash_str, schema_hash_str, accessed, size in list(
+            cur.execute(
+                "SELECT hash, schema_hash, accessed, length(errors) FROM validation"
+            )
+        )
+    }
+
+
+def remove_unused_rows(max_age=None):
+    """
+    Removes the rows that only matter alongside rows that have been removed,
+    and the processing history of datasets not seen for max_age seconds.
+    Returns the number removed.
+    """
+    cur = connect().cursor()
+    removed = 0
+
+    # The extensions are for converting, so go with the conversion
+    cur.execute("DELETE FROM extensions WHERE hash NOT IN (SELECT hash FROM cache)")
+    removed += connect().changes()
+
+    if max_age is not None:
+        cur.execute("DELETE FROM history WHERE accessed < ?", (time.time() - max_age,))
+        removed += connect().changes()
+
+    return removed
+
+
+def database_size():
+    return file_size(DATABASE_NAME) + file_size(DATABASE_NAME + "-wal")
+
+
+def gc(max_bytes=None, max_age=None):
+    """
+    Removes database entries whose files are missing. Then evicts the least
+    recently used files and cached validations that were last accessed more
+    than max_age seconds ago, or that take the cache (including the database)
+    over max_bytes. The validations of evicted content go with it. Then
+    removes the files no entry refers to (e.g. the conversion of an evicted
+    original) and compacts the database.
+    """
+    try:
+        removed = {
+            "orphaned_files": 0,
+            "missing_files": 0,
+            "evicted": 0,
+            "evicted_validations": 0,
+            "rows": 0,
+            "bytes": 0,
+        }
+
+        cur = connect().cursor()
+        entries = cache_entries()
+
+        for path, entry in list(entries.items()):
+            if not os.path.exists(path):
+                removed["missing_files"] += 1
+                remove_entry(path, entry)
+                del entries[path]
+
+        validations = validation_entries()
+
+        # Most recently used first
+        by_access = sorted(
+            [
+                (entry["accessed"], "file", path, file_size(path))
+                for path, entry in entries.items()
+            ]
+            + [
+                (entry["accessed"], "validation", key, entry["bytes"])
+                for key, entry in validations.items()
+            ],
+            key=lambda item: item[0],
+            reverse=True,
+        )
+
+        # Starting with the database besides the validations' errors
+        database_bytes = database_size()
+        total_bytes = max(
+            database_bytes - sum(entry["bytes"] for entry in validations.values()), 0
+        )
+        now = time.time()
+        evicted_hashes = set()
+
+        for accessed, kind, key, size in by_access:
+            total_bytes += size
+
+            too_old = max_age is not None and accessed < now - max_age
+            too_big = max_bytes is not None and total_bytes > max_bytes
+
+            if not too_old and not too_big:
+                continue
+
+            removed["bytes"] += size
+            total_bytes -= size
+
+            if kind == "file":
+                removed["evicted"] += 1
+                remove_entry(key, entries[key])
+                # Named <hash>.<type>
+                evicted_hashes.add(os.path.basename(key).split(".")[0])
+            else:
+                removed["evicted_validations"] += 1
+                cur.execute(
+                    "DELETE FROM validation WHERE hash = ? AND schema_hash = ?", key
+                )
+
+        # Using these again would mean having the content again first
+        for file_hash_str in evicted_hashes:
+            cur.execute("DELETE FROM validation WHERE hash = ?", (file_hash_str,))
+            removed["evicted_validations"] += connect().changes()
+
+        removed["rows"] = remove_unused_rows(max_age)
+
+        for path in set(cache_files()) - set(cache_entries()):
+            removed["orphaned_files"] += 1
+            removed["bytes"] += file_size(path)
+            os.unlink(path)
+
+        if removed["evicted_validations"] or removed["rows"]:
+            # Return the space the deleted rows took to the filesystem
+            cur.execute("VACUUM")
+            cur.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+
+        return removed
+    except Exception as e:
+        raise DatagetterCacheError(e)
+
+
+def verify():
+    """
+    Checks every file the database refers to exists, that originals match
+    their hash and that converted JSON can be parsed. Returns the problems.
+    """
+    try:
+        problems = []
+        entries = cache_entries()
+
+        for path, entry in entries.items():
+            if not os.path.exists(path):
+                problems.append({"path": path, "problem": "missing"})
+            elif os.path.dirname(path) == os.path.join(CACHE_DIR, "original"):
+                file_hash_str = os.path.basename(path).split(".")[0]
+                if hash_file(path) != file_hash_str:
+                    problems.append({"path": path, "problem": "hash mismatch"})
+            else:
+                try:
+                    with compression.open_file(path) as fp:
+                        json.load(fp)
+                except ValueError:
+                    problems.append({"path": path, "problem": "invalid JSON"})
+
+        for path in set(cache_files()) - set(entries):
+            problems.append({"path": path, "problem": "orphaned"})
+
+        return problems
     except Exception as e:
         raise DatagetterCacheError(e)
 
 
 def delete_cache():
     """Removes all cache files and databases"""
+    global hash_algorithm
+
+    close()
+    hash_algorithm = None
+    shutil.rmtree(CACHE_DIR, ignore_errors=True)
+
+    # The database is opened relative to the current directory
+    database_file = os.path.abspath(DATABASE_NAME)
     try:
-        shutil.rmtree(CACHE_DIR)
-        os.remove(DATABASE_FILE)
+        for suffix in ["", "-wal", "-shm"]:
+            if os.path.exists(database_file + suffix):
+                os.remove(database_file + suffix)
     except Exception as e:
         print(e)
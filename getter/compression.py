@@ -0,0 +1,108 @@
+"""
+Reads and writes the files in the data dir and cache, which are compressed
+when the datagetter is run with --compress. A compressed file has the suffix
+of its compression added to its name e.g. json_all/<identifier>.json.gz
+
+Downstream consumers can read any of them with open_file() e.g.
+
+    from getter.compression import open_file
+
+    with open_file(dataset["datagetter_metadata"]["json"]) as fp:
+        grants = json.load(fp)["grants"]
+"""
+import gzip
+import os
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+SUFFIXES = {"gzip": ".gz", "zstd": ".zst"}
+
+# Bytes (de)compressed at a time
+CHUNK_SIZE = 1024 * 1024
+
+
+def method_of(file_path):
+    """Returns the compression a file's name says it has, or None"""
+    for method, suffix in SUFFIXES.items():
+        if file_path.endswith(suffix):
+            return method
+
+    return None
+
+
+def suffix_of(file_path):
+    """Returns the compression suffix of a file's name, or an empty string"""
+    return SUFFIXES.get(method_of(file_path), "")
+
+
+def compressed_name(file_path, method):
+    """Returns the name file_path would have compressed with method (or None)"""
+    return file_path + SUFFIXES.get(method, "")
+
+
+def uncompressed_name(file_path):
+    return file_path[: len(file_path) - len(suffix_of(file_path))]
+
+
+def check_available(method):
+    if method == "zstd" and not zstandard:
+        raise ImportError("zstd compression needs the zstandard package installed")
+
+
+def open_file(file_path, mode="rb", method=False):
+    """
+    Opens a file in binary mode, decompressing it as it's read (or
+    compressing it as it's written) according to its suffix, or method
+    """
+    if method is False:
+        method = method_of(file_path)
+
+    if method == "gzip":
+        return gzip.open(file_path, mode)
+
+    if method == "zstd":
+        check_available(method)
+        return zstandard.open(file_path, mode)
+
+    return open(file_path, mode)
+
+
+def find(file_path):
+    """Returns the path of file_path or a compressed copy of it, or None"""
+    for suffix in ["", *SUFFIXES.values()]:
+        if os.path.exists(file_path + suffix):
+            return file_path + suffix
+
+    return None
+
+
+def recompress(file_path, method):
+    """
+    Streams file_path into a copy compressed with method (or decompressed if
+    method is None) and removes it. Returns the path of the copy, which is
+    file_path if it's already compressed that way.
+    """
+    if method_of(file_path) == method:
+        return file_path
+
+    check_available(method)
+
+    new_file_path = compressed_name(uncompressed_name(file_path), method)
+    tmp_file_path = f"{new_file_path}.tmp"
+
+    try:
+        with open_file(file_path) as src:
+            with open_file(tmp_file_path, "wb", method) as dst:
+                while chunk := src.read(CHUNK_SIZE):
+                    dst.write(chunk)
+        os.replace(tmp_file_path, new_file_path)
+    except BaseException:
+        if os.path.exists(tmp_file_path):
+            os.unlink(tmp_file_path)
+        raise
+
+    os.unlink(file_path)
+    return new_file_path
@@ -1,26 +1,46 @@
-import itertools
+import contextlib
+import glob
 import json
 import os
+import queue
 import shutil
+import sys
 import tempfile
 import time
+import threading
 import traceback
 import urllib3
-from multiprocessing import Pool
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+import multiprocessing.managers
 import requests
 from urllib3.util import Retry
 from requests.adapters import HTTPAdapter
-from decimal import Decimal
 import email.headerregistry  # (content-disposition header parser)
+from urllib.parse import urlsplit
 import strict_rfc3339
 
-from lib360dataquality.cove.schema import Schema360
-from lib360dataquality.cove.settings import COVE_CONFIG
-from lib360dataquality.cove.threesixtygiving import common_checks_360
-from libcove.lib.converters import convert_spreadsheet
-from libcove.config import LibCoveConfig
+# lib360dataquality and libcove (which brings in flattentool, openpyxl etc.)
+# take a while to import, so they're imported where they're used, the first
+# time a process converts or validates a file. See benchmarks/startup.py
 
 import getter.cache as cache
+import getter.compression as compression
+import getter.grants_index as grants_index
+import getter.metrics as metrics
+import getter.schema_store as schema_store
+import getter.shard as shard
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
 
 
 # These two lines enable debugging at httplib level (requests->urllib3->http.client)
@@ -67,12 +87,45 @@ CONTENT_TYPE_MAP = {
     "application/vnd.oasis.opendocument.spreadsheet": "ods",
 }
 
+REQUEST_HEADERS = {
+    "User-Agent": "datagetter (https://github.com/ThreeSixtyGiving/datagetter)"
+}
+
+# Bytes read from the network at a time when streaming downloads to disk
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Downloads allowed to queue per worker process in pipeline mode
+PIPELINE_QUEUE_FACTOR = 2
+
+# Schema360s built by this process, see get_schema_360()
+schemas_360 = {}
+
+# The (schema_dir, schema_path, schema_package_path, extensions) each of the
+# Schema360s in schemas_360 was built from, by id(), see validate_chunks()
+schema_360_sources = {}
+
+# Validates files with more than validation_chunk_size grants in chunks, in
+# parallel. Set by configure_validation()
+chunk_validator = None
+validation_chunk_size = None
 
-data_valid = []
-data_acceptable_license = []
-data_acceptable_license_valid = []
+# Hashes of the schema files used by Schema360s, see schema_hash()
+schema_hashes = {}
+
+# Append-only record of each dataset as it finishes, see get()
+JOURNAL_FILE = "data_journal.jsonl"
+# How the registry differs from the previous run's, see diff_registry()
+REGISTRY_DIFF_FILE = "registry_diff.json"
+METRICS_FILE = "metrics.json"
+
+# The data_<name>.json indexes written besides data_all.json, each listing the
+# datasets in the json_<name> directory
+OUTPUT_INDEXES = ["valid", "acceptable_license", "acceptable_license_valid"]
+
+# Where --grants-ndjson writes each dataset's grants, to be gathered into a
+# grants_<name>.ndjson for json_all and each of the OUTPUT_INDEXES
+GRANTS_DIR = "grants"
 
-session = requests.Session()
 retries = Retry(
     total=3,
     backoff_factor=0.1,
@@ -80,8 +133,67 @@ retries = Retry(
     allowed_methods={"POST"},
 )
 
-session.mount("https://", HTTPAdapter(max_retries=retries))
-session.mount("http://", HTTPAdapter(max_retries=retries))
+# Number of hosts each session keeps a keep-alive connection pool for
+HOST_POOLS = 256
+
+# Per-process session, see get_session()
+session = None
+session_pid = None
+
+# Limits on simultaneous downloads from each host (netloc), shared between
+# processes. Set by configure_downloads()
+host_semaphores = {}
+host_concurrency = None
+
+
+def configure_downloads(semaphores, concurrency):
+    """
+    Shares the per-host download limits with this process (Pool initializer).
+    Drops a session created before, e.g. while fetching the schemas, so that
+    the next get_session() sizes its connection pools for the new limit
+    """
+    global host_semaphores, host_concurrency, session
+    host_semaphores = semaphores
+    if concurrency != host_concurrency:
+        session = None
+    host_concurrency = concurrency
+
+
+def get_session():
+    """
+    Returns this process's requests session, creating it on first use so that
+    processes forked by the Pool don't share connection pools
+    """
+    global session, session_pid
+
+    if session is None or session_pid != os.getpid():
+        adapter = HTTPAdapter(
+            max_retries=retries,
+            pool_connections=HOST_POOLS,
+            pool_maxsize=host_concurrency or requests.adapters.DEFAULT_POOLSIZE,
+        )
+        session = requests.Session()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        session_pid = os.getpid()
+
+    return session
+
+
+def dataset_host(dataset):
+    try:
+        return urlsplit(dataset["distribution"][0]["downloadURL"]).netloc
+    except (KeyError, IndexError, TypeError, ValueError):
+        return None
+
+
+def host_semaphores_for(data_all, concurrency, context=multiprocessing):
+    """Creates a semaphore limiting downloads for each host in the registry"""
+    if not concurrency:
+        return {}
+
+    hosts = {dataset_host(dataset) for dataset in data_all} - {None}
+    return {host: context.BoundedSemaphore(concurrency) for host in hosts}
 
 
 def mkdirs(data_dir, exist_ok=False):
@@ -113,6 +225,8 @@ class ValidationError(Exception):
 
 
 def validate(working_dir, schema_360, data):
+    from lib360dataquality.cove.threesixtygiving import common_checks_360
+
     context = {"file_type": "json"}
     common_checks_360(context, working_dir, data, schema_360, test_classes=[])
     validation_errors_count = context["validation_errors_count"]
@@ -121,10 +235,392 @@ def validate(working_dir, schema_360, data):
         raise ValidationError(validation_errors_count, validation_errors)
 
 
+def configure_validation(validator, chunk_size):
+    """Shares the ChunkValidator with this process (see configure_worker)"""
+    global chunk_validator, validation_chunk_size
+    chunk_validator = validator
+    validation_chunk_size = chunk_size
+
+
+def is_chunked(data):
+    """Whether data has enough grants to be validated in chunks"""
+    return (
+        chunk_validator is not None
+        and isinstance(data, dict)
+        and isinstance(data.get("grants"), list)
+        and len(data["grants"]) > validation_chunk_size
+    )
+
+
+def grant_index(path):
+    """Returns the index of the grant an error's path is in, or None"""
+    parts = path.split("/", 2)
+    if len(parts) > 1 and parts[0] == "grants" and parts[1].isdigit():
+        return int(parts[1])
+    return None
+
+
+def chunk_errors(errors, start):
+    """
+    Returns the validation errors of a chunk starting at grant start, with the
+    paths of the grants' errors numbered within the whole file. If start is
+    None the chunk is the file with stub grants and only the errors outside
+    the grants are kept.
+    """
+    kept = []
+    for key, values in errors:
+        chunk_values = []
+        for value in values:
+            index = grant_index(value["path"])
+            if start is None:
+                if index is None:
+                    chunk_values.append(value)
+            elif index is not None:
+                parts = value["path"].split("/")
+                parts[1] = str(index + start)
+                chunk_values.append(dict(value, path="/".join(parts)))
+
+        if chunk_values:
+            kept.append((key, chunk_values))
+
+    return kept
+
+
+def validate_chunk(job):
+    """
+    Validates a chunk written by validate_chunks (in the ChunkValidator's
+    pool). Returns its errors as chunk_errors does.
+    """
+    chunk_dir, start, schema_dir, schema_path, schema_package_path, extensions = job
+
+    schema_360, _ = get_schema_360(
+        schema_dir, schema_path, schema_package_path, {"extensions": extensions}
+    )
+
+    try:
+        data = load_json(os.path.join(chunk_dir, "chunk.json"))
+        validate(chunk_dir, schema_360, data)
+    except ValidationError as e:
+        return chunk_errors(e.errors, start)
+
+    return []
+
+
+def stub_grant(grant):
+    # Just enough of a grant for the checks across the grants array (e.g. for
+    # ids that aren't unique)
+    if isinstance(grant, dict) and "id" in grant:
+        return {"id": grant["id"]}
+    return grant
+
+
+def validate_chunks(working_dir, schema_360, data):
+    """
+    Validates data as validate() does, but in parallel by the ChunkValidator:
+    each chunk of validation_chunk_size grants on its own, and the rest of the
+    file (including the checks across all the grants) once, with the grants
+    replaced by stubs. Raises ValidationError with the errors of all of them.
+    """
+    grants = data["grants"]
+    schema_dir, schema_path, schema_package_path, extensions = schema_360_sources[
+        id(schema_360)
+    ]
+
+    chunks = [(None, [stub_grant(grant) for grant in grants])] + [
+        (start, grants[start : start + validation_chunk_size])
+        for start in range(0, len(grants), validation_chunk_size)
+    ]
+
+    jobs = []
+    try:
+        for number, (start, chunk) in enumerate(chunks):
+            # A directory each, as libcove keeps the errors in the working dir
+            chunk_dir = os.path.join(working_dir, f"chunk-{number}")
+            os.makedirs(chunk_dir, exist_ok=True)
+            with open(os.path.join(chunk_dir, "chunk.json"), "wb") as fp:
+                fp.write(json_line(dict(data, grants=chunk)))
+
+            jobs.append(
+                (
+                    chunk_dir,
+                    start,
+                    schema_dir,
+                    schema_path,
+                    schema_package_path,
+                    extensions,
+                )
+            )
+
+        results = chunk_validator.validate(jobs)
+    finally:
+        for job in jobs:
+            shutil.rmtree(job[0], ignore_errors=True)
+
+    errors = {}
+    for result in results:
+        for key, values in result:
+            errors.setdefault(key, []).extend(values)
+
+    errors_count = sum(len(values) for values in errors.values())
+    if errors_count > 0:
+        raise ValidationError(errors_count, sorted(errors.items()))
+
+
+class ChunkValidator:
+    """
+    Validates the chunks of files (see validate_chunks) in a pool of
+    processes. It's run by a ValidationManager, as the workers validating the
+    files are in a Pool themselves and so can't start processes of their own.
+    """
+
+    def __init__(self, processes):
+        # The manager's process has a thread for each worker using it
+        if "forkserver" in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context("forkserver")
+        else:
+            context = multiprocessing.get_context()
+
+        self.pool = context.Pool(processes)
+
+    def validate(self, jobs):
+        return self.pool.map(validate_chunk, jobs, chunksize=1)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+
+class ValidationManager(multiprocessing.managers.BaseManager):
+    pass
+
+
+ValidationManager.register("ChunkValidator", ChunkValidator)
+
+
+@contextlib.contextmanager
+def chunk_validation(args):
+    """
+    Yields a ChunkValidator for the worker pools if --validation-chunk-size is
+    set, otherwise None
+    """
+    if not args.validation_chunk_size:
+        yield None
+        return
+
+    with ValidationManager(ctx=pool_context(args)) as manager:
+        validator = manager.ChunkValidator(args.validation_workers)
+        try:
+            yield validator
+        finally:
+            validator.close()
+
+
+def schema_hash(schema_360):
+    """Hashes the schema files a Schema360 validates against, or None if unreadable"""
+    return schema_files_hash(schema_360.schema_file, schema_360.pkg_schema_file)
+
+
+def schema_files_hash(schema_path, schema_package_path):
+    """Hashes the grant and package schema files, or None if unreadable"""
+    key = (schema_path, schema_package_path)
+
+    if key not in schema_hashes:
+        try:
+            schema_hashes[key] = "-".join(cache.hash_file(path) for path in key)
+        except cache.DatagetterCacheError:
+            schema_hashes[key] = None
+
+    return schema_hashes[key]
+
+
+def load_json(file_path):
+    """Parses a (possibly compressed) JSON file, using orjson when it's installed"""
+    with compression.open_file(file_path) as fp:
+        if not orjson:
+            return json.load(fp)
+
+        data = fp.read()
+
+    try:
+        return orjson.loads(data)
+    except orjson.JSONDecodeError:
+        # orjson is stricter than json (e.g. about NaN and big integers)
+        return json.loads(data)
+
+
+def get_cached_validation(schema_360, file_hash_str):
+    """
+    Returns the (errors_count, errors) from validating the same content against
+    the same schemas before, or None
+    """
+    schema_hash_str = schema_hash(schema_360)
+    if not schema_hash_str:
+        return None
+
+    try:
+        return cache.get_validation(file_hash_str, schema_hash_str)
+    except cache.DatagetterCacheError as e:
+        print(f"Continuing without cache (get validation): {e}")
+        return None
+
+
+def validate_file(
+    working_dir,
+    schema_360,
+    json_file_name,
+    file_hash_str,
+    data=None,
+    dataset_metrics=None,
+):
+    """
+    Validates a JSON file, reusing the cached outcome if the same content has
+    been validated against the same schemas before. data is the file already
+    parsed, if it has been. Raises ValidationError.
+    dataset_metrics: The metrics to record the time taken in (see getter.metrics)
+    """
+    with metrics.timed(dataset_metrics, "cache_lookup"):
+        cached_validation = get_cached_validation(schema_360, file_hash_str)
+    metrics.cache_hit(dataset_metrics, "validation", bool(cached_validation))
+
+    if cached_validation:
+        print("Validation cache hit")
+        errors_count, errors = cached_validation
+        if errors_count > 0:
+            raise ValidationError(errors_count, errors)
+        return
+
+    schema_hash_str = schema_hash(schema_360)
+
+    try:
+        with metrics.timed(dataset_metrics, "validation"):
+            if data is None:
+                data = load_json(json_file_name)
+
+            if is_chunked(data):
+                try:
+                    validate_chunks(working_dir, schema_360, data)
+                except ValidationError:
+                    raise
+                except Exception as e:
+                    print(f"Continuing without chunked validation: {e}")
+                    validate(working_dir, schema_360, data)
+            else:
+                validate(working_dir, schema_360, data)
+    except ValidationError as e:
+        cache_validation(file_hash_str, schema_hash_str, e.errors_count, e.errors)
+        raise
+
+    cache_validation(file_hash_str, schema_hash_str, 0, [])
+
+
+def cache_validation(file_hash_str, schema_hash_str, errors_count, errors):
+    if not schema_hash_str:
+        return
+
+    try:
+        cache.update_validation(file_hash_str, schema_hash_str, errors_count, errors)
+    except cache.DatagetterCacheError as e:
+        print(f"Continuing without cache (update validation): {e}")
+
+
+def json_line(data):
+    """Serialises data as a line of newline delimited JSON"""
+    if orjson:
+        try:
+            return orjson.dumps(data) + b"\n"
+        except TypeError:
+            # e.g. integers too big for orjson
+            pass
+
+    return json.dumps(data).encode() + b"\n"
+
+
+def declared_extensions(json_data):
+    """Returns the schema extensions a 360Giving JSON document declares"""
+    if isinstance(json_data, dict):
+        return json_data.get("extensions") or []
+
+    return []
+
+
+def get_schema_360(
+    schema_dir,
+    schema_path,
+    schema_package_path,
+    json_data=None,
+    dataset_metrics=None,
+):
+    """
+    Returns a Schema360 and its extension metadatas for the extensions declared
+    in json_data, reusing one this process has already built for the same
+    schemas and extensions rather than reading and compiling them again.
+    """
+    extensions = declared_extensions(json_data)
+    key = (schema_path, schema_package_path, json.dumps(extensions, default=str))
+
+    if key in schemas_360:
+        return schemas_360[key]
+
+    from lib360dataquality.cove.schema import Schema360
+
+    with metrics.timed(dataset_metrics, "extension_resolution"):
+        working_dir = os.path.join(schema_dir, f"{os.getpid()}-{len(schemas_360)}")
+        os.makedirs(working_dir, exist_ok=True)
+
+        schema_360 = Schema360(
+            working_dir,
+            local_pkg_schema_path=schema_package_path,
+            local_grant_schema_path=schema_path,
+        )
+
+        extension_metadatas = None
+        if extensions:
+            extension_metadatas = schema_360.resolve_extension(json_data)
+
+        schemas_360[key] = (schema_360, extension_metadatas)
+        schema_360_sources[id(schema_360)] = (
+            schema_dir,
+            schema_path,
+            schema_package_path,
+            extensions,
+        )
+
+    return schemas_360[key]
+
+
 def convert_spreadsheet_file(
-    working_dir, schema_360, original_file_path, json_file_name, file_type
+    working_dir,
+    schema_dir,
+    schema_path,
+    schema_package_path,
+    original_file_path,
+    json_file_name,
+    file_type,
+    expected_extensions=None,
+    dataset_metrics=None,
 ):
+    """
+    Converts a spreadsheet to JSON. Returns the Schema360 to validate it with
+    and the parsed JSON.
+    expected_extensions: The schema extensions the spreadsheet is expected to
+    declare (e.g. from a previous run), so it can be converted with the right
+    schema first time. It's only converted again if the expectation was wrong.
+    dataset_metrics: The metrics to record the time taken in (see getter.metrics)
+    """
+    from lib360dataquality.cove.settings import COVE_CONFIG
+    from libcove.config import LibCoveConfig
+    from libcove.lib.converters import convert_spreadsheet
+
     context = {"file_type": file_type}
+    expected_extensions = expected_extensions or []
+
+    schema_360, _ = get_schema_360(
+        schema_dir,
+        schema_path,
+        schema_package_path,
+        {"extensions": expected_extensions},
+        dataset_metrics,
+    )
 
     lib_cove_config = LibCoveConfig()
     lib_cove_config.config.update(COVE_CONFIG)
@@ -132,26 +628,36 @@ def convert_spreadsheet_file(
     # Enable internal request cache within lib-cove
     lib_cove_config.config["cache_all_requests"] = True
 
-    context.update(
-        convert_spreadsheet(
-            working_dir,
-            "null",  # upload url (not needed)
-            original_file_path,
-            file_type,
-            lib_cove_config,
-            schema_360.schema_file,
-            schema_360.pkg_schema_file,
+    with metrics.timed(dataset_metrics, "conversion"):
+        context.update(
+            convert_spreadsheet(
+                working_dir,
+                "null",  # upload url (not needed)
+                original_file_path,
+                file_type,
+                lib_cove_config,
+                schema_360.schema_file,
+                schema_360.pkg_schema_file,
+            )
         )
-    )
 
-    # Check for any schema extension
-    with open(context["converted_path"], encoding="utf-8") as fp:
-        json_data = json.load(fp, parse_float=Decimal)
+        # Check for any schema extension
+        json_data = load_json(context["converted_path"])
 
-        if extension_metadatas := schema_360.resolve_extension(json_data):
-            # Delete old coverted data
-            os.unlink(context["converted_path"])
-            # Re-convert using the newly resolve_extension
+    reconvert = False
+    if declared_extensions(json_data) != expected_extensions:
+        schema_360, extension_metadatas = get_schema_360(
+            schema_dir, schema_path, schema_package_path, json_data, dataset_metrics
+        )
+        # Re-convert if the extensions resolve, or if the expected extensions
+        # were wrong (rather than converting with the base schema)
+        reconvert = bool(extension_metadatas or expected_extensions)
+
+    if reconvert:
+        # Delete old coverted data
+        os.unlink(context["converted_path"])
+        # Re-convert using the newly resolve_extension
+        with metrics.timed(dataset_metrics, "conversion"):
             context.update(
                 convert_spreadsheet(
                     working_dir,
@@ -163,31 +669,269 @@ def convert_spreadsheet_file(
                     schema_360.pkg_schema_file,
                 )
             )
-            context["extension_metadatas"] = extension_metadatas
+            json_data = load_json(context["converted_path"])
+        context["extension_metadatas"] = extension_metadatas
 
     shutil.move(context["converted_path"], json_file_name)
 
+    return schema_360, json_data
+
+
+def download_to_file(res, file_path, dataset_metrics=None):
+    """
+    Streams a response body to file_path via a temporary file in the same
+    directory, hashing it as it arrives. Returns the cache hash and size.
+    dataset_metrics: The metrics to record the time taken in (see getter.metrics)
+    """
+    file_hash = cache.new_hash()
+    file_size = 0
+    hash_time = 0
+
+    # Named after file_path so that remove_partial_outputs() can find it
+    fd, tmp_file_path = tempfile.mkstemp(
+        dir=os.path.dirname(file_path),
+        prefix=f"{os.path.basename(file_path)}.",
+        suffix=".part",
+    )
+    try:
+        with os.fdopen(fd, "wb") as fp:
+            with metrics.timed(dataset_metrics, "download"):
+                for chunk in res.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    fp.write(chunk)
+                    hash_start = time.perf_counter()
+                    file_hash.update(chunk)
+                    hash_time += time.perf_counter() - hash_start
+                    file_size += len(chunk)
+        os.replace(tmp_file_path, file_path)
+    except BaseException:
+        os.unlink(tmp_file_path)
+        raise
+
+    # Hashing is done as the file downloads but is reported separately
+    metrics.add_time(dataset_metrics, "download", -hash_time)
+    metrics.add_time(dataset_metrics, "hash", hash_time)
+    if dataset_metrics is not None:
+        dataset_metrics["bytes_downloaded"] += file_size
+
+    return file_hash.hexdigest(), file_size
+
+
+def link_outputs(args, dataset, json_file_name):
+    """
+    Links the converted JSON into the directories the dataset qualifies for.
+    The data_*.json indexes are derived from these directories by get().
+    """
+    metadata = dataset["datagetter_metadata"]
+    # <identifier>.json, plus the suffix if it's compressed
+    file_name = os.path.basename(json_file_name)
+
+    if metadata["valid"]:
+        os.link(
+            json_file_name,
+            os.path.join(args.data_dir, "json_valid", file_name),
+        )
+        if metadata["acceptable_license"]:
+            os.link(
+                json_file_name,
+                os.path.join(args.data_dir, "json_acceptable_license_valid", file_name),
+            )
+
+    if metadata["acceptable_license"]:
+        os.link(
+            json_file_name,
+            os.path.join(args.data_dir, "json_acceptable_license", file_name),
+        )
 
-def fetch_and_convert(args, dataset, schema_path, schema_package_path):
-    """Fetches and converts 360 Giving datasets. Must return a dataset"""
 
-    working_dir = os.path.join(args.data_dir, "validation", dataset["identifier"])
-    working_dir = os.path.abspath(working_dir)
-    os.makedirs(working_dir)
+def grants_file_name(args, dataset):
+    return os.path.join(args.data_dir, GRANTS_DIR, f"{dataset['identifier']}.ndjson")
 
-    # schema_360 is per file due to possible schema extensions being present
 
-    schema_360 = Schema360(
-        working_dir,
-        local_pkg_schema_path=schema_package_path,
-        local_grant_schema_path=schema_path,
+def write_grants(args, dataset, data):
+    """
+    Writes the dataset's grants to GRANTS_DIR, one per line tagged with the
+    dataset's identifier and publisher prefix, for write_grants_streams() to
+    gather up
+    """
+    grants = data.get("grants") if isinstance(data, dict) else None
+    publisher_prefix = dataset.get("publisher", {}).get("prefix")
+
+    file_path = compression.compressed_name(
+        grants_file_name(args, dataset), args.compress
     )
+    tmp_file_path = f"{file_path}.tmp"
+
+    try:
+        with compression.open_file(tmp_file_path, "wb", args.compress) as fp:
+            for grant in grants or []:
+                fp.write(
+                    json_line(
+                        {
+                            "dataset_identifier": dataset["identifier"],
+                            "publisher_prefix": publisher_prefix,
+                            "grant": grant,
+                        }
+                    )
+                )
+        os.replace(tmp_file_path, file_path)
+    except BaseException:
+        if os.path.exists(tmp_file_path):
+            os.unlink(tmp_file_path)
+        raise
+
+
+def output_grants(args, dataset, json_file_name, data=None):
+    """
+    Writes the dataset's grants for --grants-ndjson and pulls out the fields
+    get() adds to the --grants-index. data is the JSON already parsed, if it
+    has been.
+    """
+    if not args.grants_ndjson and not args.grants_index:
+        return
+
+    # The grants are an extra, so a problem with them doesn't fail the dataset
+    try:
+        if data is None:
+            data = load_json(json_file_name)
+
+        if args.grants_ndjson:
+            write_grants(args, dataset, data)
+        if args.grants_index:
+            dataset[grants_index.ROWS_KEY] = grants_index.grant_rows(data)
+    except Exception as e:
+        print(f"Warning: Could not output the grants of {dataset['identifier']}: {e}")
+
+
+def conditional_headers(validators):
+    headers = {}
+    if validators["etag"]:
+        headers["If-None-Match"] = validators["etag"]
+    if validators["last_modified"]:
+        headers["If-Modified-Since"] = validators["last_modified"]
+
+    return headers
+
+
+def record_validators(args, dataset, download):
+    """Records the response validators so the next run can make a conditional request"""
+    metadata = dataset["datagetter_metadata"]
+    if not metadata.get("downloads"):
+        return
+    if not download["etag"] and not download["last_modified"]:
+        return
+    if not download["schema_hash_str"]:
+        return
+
+    try:
+        cache.store_original(
+            download["original_file_path"],
+            download["file_hash_str"],
+            download["file_type"],
+        )
+        cache.update_validators(
+            download["url"],
+            download["etag"],
+            download["last_modified"],
+            download["file_hash_str"],
+            download["file_type"],
+            args.schema_branch,
+            download["schema_hash_str"],
+            compression.find(download["json_file_name"]) is not None,
+            metadata,
+        )
+    except cache.DatagetterCacheError as e:
+        print(f"Continuing without cache (validators update): {e}")
+
+
+def restore_not_modified(args, dataset, validators):
+    """
+    Restores the outputs of the previous run for a dataset the publisher reports
+    as not modified. Returns False if those outputs are no longer available.
+    """
+    file_type = validators["file_type"]
+    cached_original = cache.get_original(validators["hash"], file_type)
+    if not cached_original:
+        return False
+
+    cached_json = None
+    if validators["converted"] and file_type != "json":
+        try:
+            cached_json = cache.get_file(validators["hash"])
+        except cache.DatagetterCacheError:
+            cached_json = False
+        if not cached_json or not os.path.exists(cached_json):
+            return False
+
+    original_file_path = os.path.join(
+        args.data_dir, "original", f"{dataset['identifier']}.{file_type}"
+    )
+    original_file_path += compression.suffix_of(cached_original)
+    json_file_name = os.path.join(
+        args.data_dir, "json_all", f"{dataset['identifier']}.json"
+    )
+
+    # The cache may have been written with other --compress
+    cache.link_file(cached_original, original_file_path)
+    original_file_path = compression.recompress(original_file_path, args.compress)
+
+    if validators["converted"]:
+        if file_type == "json":
+            json_file_name += compression.suffix_of(original_file_path)
+            os.link(original_file_path, json_file_name)
+        else:
+            json_file_name += compression.suffix_of(cached_json)
+            cache.link_file(cached_json, json_file_name)
+            json_file_name = compression.recompress(json_file_name, args.compress)
+
+    metadata = dataset["datagetter_metadata"]
+    previous = dict(validators["metadata"])
+    del previous["datetime_downloaded"]
+    metadata.update(previous)
+    metadata["json"] = json_file_name if previous.get("json") else None
+    metadata["acceptable_license"] = dataset["license"] in acceptable_licenses
+
+    if validators["converted"]:
+        link_outputs(args, dataset, json_file_name)
+        output_grants(args, dataset, json_file_name)
+
+    return True
+
+
+def fetch(args, dataset, schema_path, schema_package_path):
+    """
+    Downloads a dataset's file into original/. Must return a dataset and, if
+    the download needs converting and validating, a dict describing it
+    """
+
+    dataset_metrics = metrics.dataset_metrics(dataset)
+
+    # The outcome recorded for an unmodified download is only reused if it
+    # was for the same schemas
+    schema_hash_str = None
+    if args.incremental:
+        schema_hash_str = schema_files_hash(schema_path, schema_package_path)
+
+    if args.resume and is_wanted(args, dataset):
+        with metrics.timed(dataset_metrics, "total"):
+            download = resume_download(args, dataset, schema_hash_str)
+        if download:
+            return dataset, download
+
+    # Waits while the host already has its limit of downloads in progress
+    semaphore = host_semaphores.get(dataset_host(dataset))
+    with semaphore or contextlib.nullcontext():
+        with metrics.timed(dataset_metrics, "total"):
+            return fetch_dataset(args, dataset, schema_hash_str)
+
+
+def fetch_dataset(args, dataset, schema_hash_str=None):
+    dataset_metrics = metrics.dataset_metrics(dataset)
 
     # If we're only fetching particular publishers filter here
     if args.publisher_prefixes:
         if dataset["publisher"]["prefix"] not in args.publisher_prefixes:
             dataset["datagetter_metadata"] = {"downloads": False}
-            return dataset
+            return dataset, None
 
     try:
         res = None
@@ -199,18 +943,28 @@ def fetch_and_convert(args, dataset, schema_path, schema_package_path):
             raise ValueError("Unrecognised license " + dataset["license"])
 
         url = dataset["distribution"][0]["downloadURL"]
-
         metadata["datetime_downloaded"] = strict_rfc3339.now_to_rfc3339_localoffset()
 
+        validators = None
+        headers = dict(REQUEST_HEADERS)
+
+        if args.incremental and schema_hash_str:
+            try:
+                with metrics.timed(dataset_metrics, "cache_lookup"):
+                    validators = cache.get_validators(
+                        url, args.schema_branch, schema_hash_str
+                    )
+            except cache.DatagetterCacheError as e:
+                print(f"Continuing without cache (validators): {e}")
+            if validators:
+                headers.update(conditional_headers(validators))
+
         try:
             print("Fetching %s" % url)
-            res = session.get(
-                url,
-                headers={
-                    "User-Agent": "datagetter (https://github.com/ThreeSixtyGiving/datagetter)"
-                },
-                timeout=(30, 120),
-            )
+            with metrics.timed(dataset_metrics, "download"):
+                res = get_session().get(
+                    url, headers=headers, timeout=(30, 120), stream=True
+                )
             res.raise_for_status()
 
             metadata["downloads"] = True
@@ -228,7 +982,22 @@ def fetch_and_convert(args, dataset, schema_path, schema_package_path):
             metadata["error"] = str(e)
 
             if not isinstance(e, requests.exceptions.HTTPError) and not isinstance(e, urllib3.exceptions.SSLError):
-                return dataset
+                return dataset, None
+
+        if res.status_code == 304:
+            res.close()
+            with metrics.timed(dataset_metrics, "cache_lookup"):
+                restored = restore_not_modified(args, dataset, validators)
+            if restored:
+                print(f"Not modified {url}")
+                return dataset, None
+
+            # The previous outputs have gone so fetch the file again in full
+            with metrics.timed(dataset_metrics, "download"):
+                res = get_session().get(
+                    url, headers=REQUEST_HEADERS, timeout=(30, 120), stream=True
+                )
+            res.raise_for_status()
 
         content_type = res.headers.get("content-type", "").split(";")[0].lower()
         file_type = None
@@ -252,36 +1021,111 @@ def fetch_and_convert(args, dataset, schema_path, schema_package_path):
         if not file_type:
             file_type = url.split(".")[-1]
         if file_type not in CONTENT_TYPE_MAP.values():
+            res.close()
             print(f"Unrecognised file type {file_type}")
-            return dataset
+            return dataset, None
+
+        original_file_path = os.path.join(
+            args.data_dir, "original", f"{dataset['identifier']}.{file_type}"
+        )
+
+        with res:
+            file_hash_str, file_size = download_to_file(
+                res, original_file_path, dataset_metrics
+            )
+
+        json_file_name = os.path.join(
+            args.data_dir, "json_all", f"{dataset['identifier']}.json"
+        )
+
+        download = {
+            "url": url,
+            "file_type": file_type,
+            "file_size": file_size,
+            "file_hash_str": file_hash_str,
+            "original_file_path": original_file_path,
+            "json_file_name": json_file_name,
+            "etag": res.headers.get("etag"),
+            "last_modified": res.headers.get("last-modified"),
+            "schema_hash_str": schema_hash_str,
+        }
+
+    # Exception catcher if /anything/ went wrong in fetch function
+    # we don't want to crash out
+    except Exception as e:
+        metadata["valid"] = False
+        metadata["downloads"] = False
+        metadata["json"] = None
+        print(f"Unknown issue with {url} {e}")
+        return dataset, None
+
+    return dataset, download
+
+
+def convert_and_validate(args, dataset, download, schema_path, schema_package_path):
+    """Converts and validates a downloaded dataset. Must return a dataset"""
+
+    with metrics.timed(metrics.dataset_metrics(dataset), "total"):
+        return convert_and_validate_dataset(
+            args, dataset, download, schema_path, schema_package_path
+        )
+
+
+def convert_and_validate_dataset(
+    args, dataset, download, schema_path, schema_package_path
+):
+    dataset_metrics = metrics.dataset_metrics(dataset)
+    metadata = dataset["datagetter_metadata"]
+    file_type = download["file_type"]
+    file_hash_str = download["file_hash_str"]
+    original_file_path = download["original_file_path"]
+    json_file_name = download["json_file_name"]
+
+    try:
+        working_dir = os.path.join(args.data_dir, "validation", dataset["identifier"])
+        working_dir = os.path.abspath(working_dir)
+        os.makedirs(working_dir)
+
+        # Schema360s are shared between datasets with the same schema extensions
+        schema_dir = os.path.join(args.data_dir, "validation", ".schema")
+        schema_dir = os.path.abspath(schema_dir)
+        schema_360, _ = get_schema_360(
+            schema_dir, schema_path, schema_package_path, None, dataset_metrics
+        )
+
+        # The JSON parsed from the file, so it's only parsed the once
+        data = None
 
         # Check that the downloaded json file is valid json and not junk from the webserver
         # e.g. a 500 error being output without the proper status code.
+        # Content that has been validated before is known to be JSON so isn't parsed.
+        validated = False
         if file_type == "json":
+            with metrics.timed(dataset_metrics, "cache_lookup"):
+                validated = get_cached_validation(schema_360, file_hash_str)
+
+        if file_type == "json" and not validated:
             try:
-                json.loads(res.text)
+                with metrics.timed(dataset_metrics, "validation"):
+                    data = load_json(original_file_path)
             except ValueError:
                 print("Warning: JSON file provided by webserver is invalid")
+                os.unlink(original_file_path)
                 metadata["downloads"] = False
                 metadata["error"] = "Invalid JSON file provided by webserver"
                 return dataset
 
         metadata["file_type"] = file_type
-
-        original_file_path = os.path.join(
-            args.data_dir, "original", f"{dataset['identifier']}.{file_type}"
-        )
-
-        with open(original_file_path, "wb") as fp:
-            fp.write(res.content)
-
-        json_file_name = os.path.join(
-            args.data_dir, "json_all", f"{dataset['identifier']}.json"
-        )
-
-        metadata["file_size"] = os.path.getsize(original_file_path)
+        metadata["file_size"] = download["file_size"]
 
         if file_type == "json":
+            # The JSON output is the original, compressed the same
+            original_file_path = compression.recompress(
+                original_file_path, args.compress
+            )
+            download["original_file_path"] = original_file_path
+            json_file_name += compression.suffix_of(original_file_path)
+
             os.link(original_file_path, json_file_name)
             metadata["json"] = json_file_name
         else:
@@ -289,30 +1133,67 @@ def fetch_and_convert(args, dataset, schema_path, schema_package_path):
             try:
                 print(f"Running convert on {original_file_path} to {json_file_name}")
 
-                try:
-                    # Hash the file
-                    file_hash_str = cache.hash_file(original_file_path)
-                    # Check if we have already converted the file
-                    cached_file_path = cache.get_file(file_hash_str)
-
-                    # We have converted the file before so copy from the CACHE_DIR
-                    if cached_file_path:
-                        try:
-                            shutil.copy(cached_file_path, json_file_name)
-                            print("Cache hit")
-                        except (FileNotFoundError, PermissionError):
-                            cached_file_path = False
-                except cache.DatagetterCacheError as e:
-                    print(f"Continuing without cache (hash/get): {e}")
-                    cached_file_path = False
+                with metrics.timed(dataset_metrics, "cache_lookup"):
+                    try:
+                        # The extensions declared by this file, or failing that
+                        # the last file from this dataset
+                        expected_extensions = cache.get_extensions(
+                            file_hash_str, dataset["identifier"]
+                        )
+                    except cache.DatagetterCacheError as e:
+                        print(f"Continuing without cache (get extensions): {e}")
+                        expected_extensions = None
+
+                    try:
+                        # Check if we have already converted the file
+                        cached_file_path = cache.get_file(file_hash_str)
+
+                        # We have converted the file before so copy from the CACHE_DIR
+                        if cached_file_path:
+                            cached_json_file_name = (
+                                json_file_name + compression.suffix_of(cached_file_path)
+                            )
+                            try:
+                                cache.link_file(cached_file_path, cached_json_file_name)
+                                json_file_name = cached_json_file_name
+                                print("Cache hit")
+                            except (FileNotFoundError, PermissionError):
+                                cached_file_path = False
+                    except cache.DatagetterCacheError as e:
+                        print(f"Continuing without cache (get): {e}")
+                        cached_file_path = False
+
+                metrics.cache_hit(dataset_metrics, "conversion", bool(cached_file_path))
 
-                if not cached_file_path:
-                    convert_spreadsheet_file(
+                if cached_file_path:
+                    # The cache may have been written with other --compress
+                    json_file_name = compression.recompress(
+                        json_file_name, args.compress
+                    )
+
+                    # Validate against the extensions it was converted with
+                    if expected_extensions:
+                        schema_360, _ = get_schema_360(
+                            schema_dir,
+                            schema_path,
+                            schema_package_path,
+                            {"extensions": expected_extensions},
+                            dataset_metrics,
+                        )
+                else:
+                    schema_360, data = convert_spreadsheet_file(
                         working_dir,
-                        schema_360,
+                        schema_dir,
+                        schema_path,
+                        schema_package_path,
                         original_file_path,
                         json_file_name,
                         file_type,
+                        expected_extensions,
+                        dataset_metrics,
+                    )
+                    json_file_name = compression.recompress(
+                        json_file_name, args.compress
                     )
 
                     try:
@@ -322,6 +1203,11 @@ def fetch_and_convert(args, dataset, schema_path, schema_package_path):
                             dataset["identifier"],
                             file_type,
                         )
+                        cache.update_extensions(
+                            file_hash_str,
+                            dataset["identifier"],
+                            declared_extensions(data),
+                        )
                     except cache.DatagetterCacheError as e:
                         print(f"Continuing without cache (update error): {e}")
 
@@ -336,14 +1222,34 @@ def fetch_and_convert(args, dataset, schema_path, schema_package_path):
             else:
                 metadata["json"] = json_file_name
 
+            # Finished with the spreadsheet
+            download["original_file_path"] = compression.recompress(
+                original_file_path, args.compress
+            )
+
+            if metadata["json"]:
+                # Kept with the conversion, so the cache can be rekeyed by
+                # rehashing it (see cache.migrate_hashes)
+                try:
+                    cache.store_original(
+                        download["original_file_path"], file_hash_str, file_type
+                    )
+                except cache.DatagetterCacheError as e:
+                    print(f"Continuing without cache (store original): {e}")
+
         metadata["acceptable_license"] = dataset["license"] in acceptable_licenses
 
         # We can only do continue with the JSON if it did successfully convert.
         if metadata.get("json"):
             try:
-                with open(json_file_name, "r") as fp:
-                    data = json.load(fp)
-                    validate(working_dir, schema_360, data)
+                validate_file(
+                    working_dir,
+                    schema_360,
+                    json_file_name,
+                    file_hash_str,
+                    data,
+                    dataset_metrics,
+                )
             except ValidationError as e:
                 print(
                     f"Warning: File {json_file_name} does not conform to 360Giving standard"
@@ -357,87 +1263,899 @@ def fetch_and_convert(args, dataset, schema_path, schema_package_path):
             else:
                 metadata["valid"] = True
 
-            if metadata["valid"]:
-                os.link(
-                    json_file_name,
-                    "{}/json_valid/{}.json".format(
-                        args.data_dir, dataset["identifier"]
-                    ),
-                )
-                data_valid.append(dataset)
-                if metadata["acceptable_license"]:
-                    os.link(
-                        json_file_name,
-                        "{}/json_acceptable_license_valid/{}.json".format(
-                            args.data_dir, dataset["identifier"]
-                        ),
-                    )
-                    data_acceptable_license_valid.append(dataset)
+            link_outputs(args, dataset, json_file_name)
+            output_grants(args, dataset, json_file_name, data)
 
-            if metadata["acceptable_license"]:
-                os.link(
-                    json_file_name,
-                    "{}/json_acceptable_license/{}.json".format(
-                        args.data_dir, dataset["identifier"]
-                    ),
-                )
-                data_acceptable_license.append(dataset)
+        if args.incremental:
+            record_validators(args, dataset, download)
 
-    # Exception catcher if /anything/ went wrong in fetch_and_convert function
+    # Exception catcher if /anything/ went wrong in convert_and_validate function
     # we don't want to crash out
     except Exception as e:
         metadata["valid"] = False
         metadata["downloads"] = False
         metadata["json"] = None
-        print(f"Unknown issue with {url} {e}")
+        print(f"Unknown issue with {download['url']} {e}")
+
+    return dataset
+
+
+def fetch_and_convert(args, dataset, schema_path, schema_package_path):
+    """Fetches and converts 360 Giving datasets. Must return a dataset"""
+
+    dataset, download = fetch(args, dataset, schema_path, schema_package_path)
+    if download:
+        dataset = convert_and_validate(
+            args, dataset, download, schema_path, schema_package_path
+        )
 
     return dataset
 
 
-def file_cache(url):
-    res = session.get(url)
-    res.raise_for_status()
+def fetch_and_convert_job(job):
+    """
+    fetch_and_convert for run_pool, keeping track of the dataset's
+    position. A download over --large-file-size is returned unconverted, to be
+    converted in the large file pool.
+    """
+    args, index, dataset, schema_path, schema_package_path = job
 
-    tmp_dir = tempfile.mkdtemp()
-    out_file = os.path.join(tmp_dir, os.path.basename(url))
+    dataset, download = fetch(args, dataset, schema_path, schema_package_path)
+    if download and not is_large_file(args, download):
+        dataset = convert_and_validate(
+            args, dataset, download, schema_path, schema_package_path
+        )
+        download = None
 
-    print(f"Caching {url} to {out_file}")
+    return index, dataset, download
 
-    with open(out_file, "w") as fp:
-        fp.write(res.text)
 
-    return out_file
+def current_rss():
+    """Returns the resident set size of this process in bytes"""
+    try:
+        with open("/proc/self/statm") as fp:
+            return int(fp.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        pass
 
+    if resource is None:
+        return 0
 
-def get(args):
-    base_url = "https://raw.githubusercontent.com/ThreeSixtyGiving/standard"
-    schema_path = file_cache(
-        f"{base_url}/{args.schema_branch}/schema/360-giving-schema.json"
+    # The peak rather than the current size, in kilobytes except on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+def run_measured(func, args):
+    """
+    Runs func(*args) in a RecyclingPool worker. Returns whether it succeeded,
+    what it returned (or raised) and the worker's resident set size after.
+    """
+    try:
+        return True, func(*args), current_rss()
+    except Exception as e:
+        return False, e, current_rss()
+
+
+class RecyclingPool:
+    """
+    A pool of processes that replaces a worker with a fresh one after
+    max_tasks tasks, or after a task that leaves it using more than max_rss
+    bytes. Each worker is a ProcessPoolExecutor of one process, fed tasks by a
+    thread here, which is shut down and started afresh to replace it. Has the
+    parts of the Pool interface the datagetter uses.
+    """
+
+    def __init__(
+        self,
+        context,
+        processes,
+        initializer=None,
+        initargs=(),
+        max_tasks=None,
+        max_rss=None,
+    ):
+        self.context = context
+        self.initializer = initializer
+        self.initargs = initargs
+        self.max_tasks = max_tasks
+        self.max_rss = max_rss
+
+        # (func, args, callback, error_callback), or None to stop a thread
+        self.tasks = queue.Queue()
+        self.threads = [
+            threading.Thread(target=self.run_worker, daemon=True)
+            for _ in range(processes)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def new_worker(self):
+        return ProcessPoolExecutor(
+            1,
+            mp_context=self.context,
+            initializer=self.initializer,
+            initargs=self.initargs,
+        )
+
+    def run_worker(self):
+        worker = self.new_worker()
+        completed = 0
+
+        try:
+            while (task := self.tasks.get()) is not None:
+                func, args, callback, error_callback = task
+
+                try:
+                    succeeded, result, rss = worker.submit(
+                        run_measured, func, args
+                    ).result()
+                except BrokenProcessPool as e:
+                    # The process died (e.g. killed for running out of memory)
+                    worker.shutdown()
+                    worker = self.new_worker()
+                    completed = 0
+                    error_callback(e)
+                    continue
+
+                completed += 1
+                too_big = self.max_rss and rss > self.max_rss
+                if too_big:
+                    print(f"Replacing worker process using {rss} bytes")
+                if too_big or (self.max_tasks and completed >= self.max_tasks):
+                    worker.shutdown()
+                    worker = self.new_worker()
+                    completed = 0
+
+                if succeeded:
+                    callback(result)
+                else:
+                    error_callback(result)
+        finally:
+            worker.shutdown()
+
+    def apply_async(self, func, args=(), callback=None, error_callback=None):
+        self.tasks.put(
+            (func, args, callback or (lambda result: None), error_callback or print)
+        )
+
+    def close(self):
+        """Waits for the tasks to be done and the workers to exit"""
+        for _ in self.threads:
+            self.tasks.put(None)
+        for thread in self.threads:
+            thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        # Like a Pool's terminate(), abandons the tasks not yet started
+        if exc_type is not None:
+            while True:
+                try:
+                    self.tasks.get_nowait()
+                except queue.Empty:
+                    break
+
+        self.close()
+
+
+def pool_context(args):
+    """
+    Returns the multiprocessing context for the pools and what they share.
+    That's forkserver (where available) if workers are being replaced, as
+    replacements are started while the download threads are running and a
+    fork could copy a lock one of them is holding.
+    """
+    if (
+        args.max_tasks_per_child or args.worker_max_rss
+    ) and "forkserver" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("forkserver")
+
+    return multiprocessing.get_context()
+
+
+def configure_worker(validator, chunk_size, initializer=None, initargs=()):
+    """Pool initializer for the worker pools, see worker_pool()"""
+    configure_validation(validator, chunk_size)
+    if initializer:
+        initializer(*initargs)
+
+
+def worker_pool(args, processes, validator, initializer=None, initargs=()):
+    """
+    Returns a Pool of processes for converting and validating, whose workers
+    are replaced after --max-tasks-per-child datasets or once they're using
+    more than --worker-max-rss. validator is the ChunkValidator from
+    chunk_validation(), initializer is run in each worker as well.
+    """
+    initargs = (validator, args.validation_chunk_size, initializer, initargs)
+
+    if args.max_tasks_per_child or args.worker_max_rss:
+        return RecyclingPool(
+            pool_context(args),
+            processes,
+            initializer=configure_worker,
+            initargs=initargs,
+            max_tasks=args.max_tasks_per_child,
+            max_rss=args.worker_max_rss,
+        )
+
+    return pool_context(args).Pool(
+        processes, initializer=configure_worker, initargs=initargs
+    )
+
+
+def large_file_pool(args, validator):
+    """
+    Returns the pool of --large-file-workers processes that converts and
+    validates the downloads over --large-file-size, if it's set
+    """
+    if args.large_file_size is None:
+        return contextlib.nullcontext()
+
+    return worker_pool(args, args.large_file_workers, validator)
+
+
+def is_large_file(args, download):
+    return (
+        args.large_file_size is not None
+        and download["file_size"] > args.large_file_size
+    )
+
+
+def convert_async(
+    process_pool, args, dataset, download, schema_path, schema_package_path, done
+):
+    """
+    Converts and validates a download in process_pool, calling done with the
+    dataset, or with the dataset as it was if that fails
+    """
+
+    def failed(e):
+        print(f"Conversion failed for dataset {dataset['identifier']}: {e}")
+        done(dataset)
+
+    process_pool.apply_async(
+        convert_and_validate,
+        (args, dataset, download, schema_path, schema_package_path),
+        callback=done,
+        error_callback=failed,
     )
-    schema_package_path = file_cache(
-        f"{base_url}/{args.schema_branch}/schema/360-giving-package-schema.json"
+
+
+def run_pool(args, jobs, schema_path, schema_package_path, semaphores):
+    """
+    Fetches and converts each (position, dataset) in jobs in a pool of
+    processes. Yields the position and dataset of each as it finishes, or the
+    dataset as it was if its worker failed (e.g. was killed for its memory).
+    """
+    finished = queue.Queue()
+
+    with chunk_validation(args) as validator, worker_pool(
+        args,
+        args.threads,
+        validator,
+        initializer=configure_downloads,
+        initargs=(semaphores, args.host_concurrency),
+    ) as process_pool, large_file_pool(args, validator) as large_pool:
+
+        def fetched(result):
+            index, dataset, download = result
+            if download:
+                convert_async(
+                    large_pool,
+                    args,
+                    dataset,
+                    download,
+                    schema_path,
+                    schema_package_path,
+                    lambda dataset: finished.put((index, dataset)),
+                )
+            else:
+                finished.put((index, dataset))
+
+        for index, dataset in jobs:
+
+            def failed(e, index=index, dataset=dataset):
+                print(f"Fetch failed for dataset {dataset.get('identifier')}: {e}")
+                finished.put((index, dataset))
+
+            process_pool.apply_async(
+                fetch_and_convert_job,
+                ((args, index, dataset, schema_path, schema_package_path),),
+                callback=fetched,
+                error_callback=failed,
+            )
+
+        for _ in jobs:
+            yield finished.get()
+
+
+def run_pipeline(args, jobs, schema_path, schema_package_path):
+    """
+    Downloads each (position, dataset) in jobs in a pool of threads, handing
+    each download to a pool of processes to be converted and validated, or to
+    the large file pool if it's over --large-file-size. Yields the position
+    and dataset of each as it finishes.
+    """
+
+    # Bounds the finished downloads waiting on (or being processed by) the
+    # process pool, so the download threads don't race ahead of conversion.
+    # Downloads in progress don't take a slot, so --download-concurrency
+    # isn't limited by the number of workers.
+    queue_slots = threading.BoundedSemaphore(args.workers * PIPELINE_QUEUE_FACTOR)
+    finished = queue.Queue()
+
+    with chunk_validation(args) as validator, worker_pool(
+        args, args.workers, validator
+    ) as process_pool, large_file_pool(args, validator) as large_pool:
+
+        def fetch_and_submit(index, dataset):
+            download = None
+            try:
+                dataset, download = fetch(
+                    args, dataset, schema_path, schema_package_path
+                )
+            except Exception:
+                traceback.print_exc()
+
+            if not download:
+                finished.put((index, dataset))
+                return
+
+            # Waits (holding up this download thread) while the pools are
+            # behind
+            queue_slots.acquire()
+
+            def converted(dataset):
+                queue_slots.release()
+                finished.put((index, dataset))
+
+            convert_async(
+                large_pool if is_large_file(args, download) else process_pool,
+                args,
+                dataset,
+                download,
+                schema_path,
+                schema_package_path,
+                converted,
+            )
+
+        with ThreadPoolExecutor(args.download_concurrency) as download_pool:
+            for index, dataset in jobs:
+                download_pool.submit(fetch_and_submit, index, dataset)
+
+            for _ in jobs:
+                yield finished.get()
+
+
+def head_content_length(url):
+    """Returns the Content-Length a HEAD request for url gives, or None"""
+    try:
+        res = get_session().head(
+            url, headers=REQUEST_HEADERS, timeout=(10, 30), allow_redirects=True
+        )
+        res.raise_for_status()
+        return int(res.headers["content-length"])
+    except (requests.exceptions.RequestException, KeyError, ValueError):
+        return None
+
+
+def estimate_seconds(args, jobs, previous_data_all, semaphores):
+    """
+    Estimates how long each (position, dataset) in jobs will take, as a dict
+    of position to seconds. Uses how long the dataset took last time, or else
+    its size from last time (or with --head-sizes a HEAD request) at the rate
+    files of its type were processed. Without any rates the sizes in bytes are
+    the estimates, but only if there's nothing estimated in seconds to compare
+    them with. None where there's nothing to go on.
+    semaphores: The per-host download limits (see host_semaphores_for), which
+    the HEAD requests keep to as well
+    """
+    try:
+        history = cache.get_history()
+    except cache.DatagetterCacheError as e:
+        print(f"Continuing without cache (history): {e}")
+        history = {}
+
+    # Sizes from a previous data_all.json in the data dir
+    previous_sizes = {
+        dataset.get("identifier"): dataset["datagetter_metadata"].get("file_size")
+        for dataset in previous_data_all
+        if dataset.get("datagetter_metadata")
+    }
+
+    # Bytes processed per second by file type, and overall (key None)
+    totals = {}
+    for file_type, file_size, seconds in history.values():
+        if file_size and seconds:
+            for key in [file_type, None]:
+                total_size, total_seconds = totals.get(key, (0, 0))
+                totals[key] = (total_size + file_size, total_seconds + seconds)
+    rates = {key: size / seconds for key, (size, seconds) in totals.items()}
+
+    estimates = {}
+    sizes = {}
+    for index, dataset in jobs:
+        identifier = dataset.get("identifier")
+        file_type, file_size, seconds = history.get(identifier, (None, None, None))
+
+        if seconds is not None:
+            estimates[index] = seconds
+        else:
+            sizes[index] = (file_type, file_size or previous_sizes.get(identifier))
+
+    # Only ask the publishers for the sizes we don't know
+    def head(index):
+        try:
+            url = datasets[index]["distribution"][0]["downloadURL"]
+        except (KeyError, IndexError):
+            return None
+
+        semaphore = semaphores.get(dataset_host(datasets[index]))
+        with semaphore or contextlib.nullcontext():
+            return head_content_length(url)
+
+    datasets = dict(jobs)
+    unknown = [index for index, (_, file_size) in sizes.items() if file_size is None]
+    if args.head_sizes and unknown:
+        with ThreadPoolExecutor(args.head_concurrency) as head_pool:
+            for index, file_size in zip(unknown, head_pool.map(head, unknown)):
+                sizes[index] = (None, file_size)
+
+    unrated = {}
+    for index, (file_type, file_size) in sizes.items():
+        rate = rates.get(file_type) or rates.get(None)
+        if file_size is None:
+            estimates[index] = None
+        elif rate:
+            estimates[index] = file_size / rate
+        else:
+            unrated[index] = file_size
+
+    # Bytes can't be compared with seconds
+    if any(estimate is not None for estimate in estimates.values()):
+        unrated = dict.fromkeys(unrated)
+    estimates.update(unrated)
+
+    return estimates
+
+
+def longest_first(args, jobs, previous_data_all, semaphores):
+    """
+    Orders jobs so the datasets expected to take longest start first, rather
+    than a big file late in the registry leaving one worker busy long after
+    the rest have finished. Datasets with no estimate go first in case
+    they're the big ones.
+    """
+    jobs_to_estimate = [
+        (index, dataset)
+        for index, dataset in jobs
+        if not args.publisher_prefixes
+        or dataset.get("publisher", {}).get("prefix") in args.publisher_prefixes
+    ]
+    estimates = estimate_seconds(args, jobs_to_estimate, previous_data_all, semaphores)
+
+    def estimate(job):
+        index, _ = job
+        if index not in estimates:
+            # Filtered out by --publishers so there's nothing to do
+            return 0
+        if estimates[index] is None:
+            return float("inf")
+        return estimates[index]
+
+    return sorted(jobs, key=estimate, reverse=True)
+
+
+def record_history(new_data_all, metrics_by_identifier):
+    """Records how long each dataset took, for ordering the next run"""
+    history = []
+    for dataset in new_data_all:
+        dataset_metrics = metrics_by_identifier.get(dataset.get("identifier"))
+        if not dataset_metrics or "total" not in dataset_metrics["timings"]:
+            continue
+
+        metadata = dataset.get("datagetter_metadata", {})
+        history.append(
+            (
+                dataset["identifier"],
+                metadata.get("file_type"),
+                metadata.get("file_size"),
+                dataset_metrics["timings"]["total"],
+            )
+        )
+
+    try:
+        cache.update_history(history)
+    except cache.DatagetterCacheError as e:
+        print(f"Continuing without cache (update history): {e}")
+
+
+def load_journal(args):
+    """Returns the datasets an earlier run recorded as finished, by identifier"""
+    finished = {}
+
+    try:
+        with open(os.path.join(args.data_dir, JOURNAL_FILE), "r+b") as journal:
+            line = b""
+            for line in journal:
+                try:
+                    dataset = json.loads(line)["dataset"]
+                except ValueError:
+                    # The run died part way through writing this line
+                    continue
+                finished[dataset.get("identifier")] = dataset
+
+            # Drop an unfinished last line, so this run's start on a line of
+            # their own
+            if line and not line.endswith(b"\n"):
+                journal.truncate(journal.tell() - len(line))
+    except FileNotFoundError:
+        pass
+
+    return finished
+
+
+def remove_partial_outputs(args, dataset):
+    """
+    Removes what an interrupted run output for a dataset it didn't finish,
+    apart from the original which resume_download() reuses
+    """
+    identifier = dataset.get("identifier")
+
+    # Downloads download_to_file() didn't get to finish
+    for file_type in CONTENT_TYPE_MAP.values():
+        original_file_path = os.path.join(
+            args.data_dir, "original", f"{identifier}.{file_type}"
+        )
+        for part_file_path in glob.glob(f"{glob.escape(original_file_path)}.*.part"):
+            os.unlink(part_file_path)
+
+    for dir_name in ["json_all"] + [f"json_{name}" for name in OUTPUT_INDEXES]:
+        json_file_name = os.path.join(args.data_dir, dir_name, f"{identifier}.json")
+        while found := compression.find(json_file_name):
+            os.unlink(found)
+
+    while found := compression.find(grants_file_name(args, dataset)):
+        os.unlink(found)
+
+    shutil.rmtree(
+        os.path.join(args.data_dir, "validation", str(identifier)), ignore_errors=True
     )
 
+
+def remove_outputs(args, dataset):
+    """Removes everything in the data dir for a dataset, including its original"""
+    remove_partial_outputs(args, dataset)
+
+    for file_type in CONTENT_TYPE_MAP.values():
+        original_file_path = os.path.join(
+            args.data_dir, "original", f"{dataset.get('identifier')}.{file_type}"
+        )
+        while found := compression.find(original_file_path):
+            os.unlink(found)
+
+
+def registry_entry(dataset):
+    """The parts of a registry entry that, if changed, mean processing it again"""
     try:
-        cache.setup_database()
+        url = dataset["distribution"][0]["downloadURL"]
+    except (KeyError, IndexError, TypeError):
+        url = None
+
+    return url, dataset.get("license"), dataset.get("modified")
+
+
+def has_outputs(args, dataset):
+    """Whether the previous run downloaded the dataset and its outputs are still there"""
+    metadata = dataset.get("datagetter_metadata", {})
+    if not metadata.get("downloads"):
+        return False
+
+    if metadata.get("json") and not os.path.exists(metadata["json"]):
+        return False
+
+    original_file_path = os.path.join(
+        args.data_dir,
+        "original",
+        f"{dataset.get('identifier')}.{metadata.get('file_type')}",
+    )
+    return compression.find(original_file_path) is not None
+
+
+def diff_registry(args, data_all, previous_data_all):
+    """
+    Compares the registry with the previous run's, writing the identifiers of
+    the added, removed, changed (download URL, license or modified date) and
+    unchanged datasets to REGISTRY_DIFF_FILE. Unchanged datasets the previous
+    run didn't download, or whose outputs have gone, are retried.
+
+    Returns the positions and datasets of those carried forward, with the
+    previous run's results, and the datasets that have been removed.
+    """
+    previous = {dataset.get("identifier"): dataset for dataset in previous_data_all}
+    identifiers = {dataset.get("identifier") for dataset in data_all}
+
+    diff = {"added": [], "removed": [], "changed": [], "unchanged": [], "retried": []}
+    carried_forward = {}
+
+    for index, dataset in enumerate(data_all):
+        identifier = dataset.get("identifier")
+        previous_dataset = previous.get(identifier)
+
+        if previous_dataset is None:
+            diff["added"].append(identifier)
+        elif registry_entry(dataset) != registry_entry(previous_dataset):
+            diff["changed"].append(identifier)
+        else:
+            diff["unchanged"].append(identifier)
+
+            if has_outputs(args, previous_dataset):
+                dataset["datagetter_metadata"] = previous_dataset["datagetter_metadata"]
+                carried_forward[index] = dataset
+                continue
+
+            diff["retried"].append(identifier)
+
+        # When resuming these were cleared by the run that's being resumed,
+        # so anything there now is from that run
+        if not args.resume:
+            remove_outputs(args, dataset)
+
+    removed = [
+        dataset
+        for identifier, dataset in previous.items()
+        if identifier not in identifiers
+    ]
+    for dataset in removed:
+        remove_outputs(args, dataset)
+    diff["removed"] = [dataset.get("identifier") for dataset in removed]
+
+    print(
+        "Registry diff: "
+        + ", ".join(f"{len(changes)} {name}" for name, changes in diff.items())
+    )
+    write_json(os.path.join(args.data_dir, REGISTRY_DIFF_FILE), diff)
+
+    return carried_forward, removed
+
+
+def carry_forward_grants(args, datasets, index_con, removed):
+    """
+    Adds the grants outputs the datasets carried forward by diff_registry()
+    don't have (e.g. if the previous run was without --grants-ndjson) and
+    takes the removed datasets out of the grants index
+    """
+    indexed = set()
+    if index_con:
+        try:
+            grants_index.remove_datasets(
+                index_con, [dataset.get("identifier") for dataset in removed]
+            )
+            indexed = grants_index.dataset_identifiers(index_con)
+        except grants_index.GrantsIndexError as e:
+            print(f"Could not update the grants index: {e}")
+
+    for dataset in datasets:
+        not_indexed = index_con and dataset["identifier"] not in indexed
+        json_file_name = dataset["datagetter_metadata"].get("json")
+
+        if json_file_name and (
+            not_indexed
+            or (
+                args.grants_ndjson
+                and not compression.find(grants_file_name(args, dataset))
+            )
+        ):
+            output_grants(args, dataset, json_file_name)
+
+        grant_rows = dataset.pop(grants_index.ROWS_KEY, None)
+        if not_indexed:
+            try:
+                grants_index.add_dataset(index_con, dataset, grant_rows)
+            except grants_index.GrantsIndexError as e:
+                print(f"Could not index the grants of {dataset['identifier']}: {e}")
+
+
+def is_wanted(args, dataset):
+    """
+    Whether fetch_dataset() would download the dataset, rather than skip it
+    for --publishers or fail it for an unrecognised licence
+    """
+    if args.publisher_prefixes:
+        if dataset["publisher"]["prefix"] not in args.publisher_prefixes:
+            return False
+
+    return dataset.get("license") in acceptable_licenses + unacceptable_licenses
+
+
+def resume_download(args, dataset, schema_hash_str=None):
+    """
+    Returns a download for the original an interrupted run already downloaded
+    for the dataset, or None. Downloads are renamed into original/ when
+    complete so any file found there is whole. Its HTTP validators are only
+    known if a previous run recorded them (against schema_hash_str) for the
+    same content.
+    """
+    identifier = dataset.get("identifier")
+
+    for file_type in CONTENT_TYPE_MAP.values():
+        original_file_path = compression.find(
+            os.path.join(args.data_dir, "original", f"{identifier}.{file_type}")
+        )
+        if original_file_path:
+            break
+    else:
+        return None
+
+    try:
+        # Spreadsheets are converted from the uncompressed file
+        original_file_path = compression.recompress(original_file_path, None)
+
+        with metrics.timed(metrics.dataset_metrics(dataset), "hash"):
+            file_hash_str = cache.hash_file(original_file_path)
+    except (OSError, cache.DatagetterCacheError) as e:
+        print(f"Downloading again, could not hash {original_file_path}: {e}")
+        return None
+
+    print(f"Resuming with {original_file_path}")
+
+    url = dataset["distribution"][0]["downloadURL"]
+    validators = None
+    if args.incremental and schema_hash_str:
+        try:
+            validators = cache.get_validators(url, args.schema_branch, schema_hash_str)
+        except cache.DatagetterCacheError as e:
+            print(f"Continuing without cache (validators): {e}")
+    if not validators or validators["hash"] != file_hash_str:
+        validators = {"etag": None, "last_modified": None}
+
+    metadata = dataset.setdefault("datagetter_metadata", {})
+    metadata["datetime_downloaded"] = strict_rfc3339.timestamp_to_rfc3339_localoffset(
+        os.path.getmtime(original_file_path)
+    )
+    metadata["downloads"] = True
+
+    return {
+        "url": url,
+        "file_type": file_type,
+        "file_size": os.path.getsize(original_file_path),
+        "file_hash_str": file_hash_str,
+        "original_file_path": original_file_path,
+        "json_file_name": os.path.join(args.data_dir, "json_all", f"{identifier}.json"),
+        "etag": validators["etag"],
+        "last_modified": validators["last_modified"],
+        "schema_hash_str": schema_hash_str,
+    }
+
+
+def in_output_dir(args, dataset, dir_name):
+    json_file_name = os.path.join(
+        args.data_dir, dir_name, f"{dataset.get('identifier')}.json"
+    )
+    return compression.find(json_file_name) is not None
+
+
+def write_json(file_path, data):
+    """Writes JSON via a temporary file so a partly written file is never left"""
+    tmp_file_path = f"{file_path}.tmp"
+    with open(tmp_file_path, "w") as fp:
+        json.dump(data, fp, indent=4)
+    os.replace(tmp_file_path, file_path)
+
+
+def write_indexes(args, new_data_all):
+    """Writes data_all.json and the data_*.json index for each output directory"""
+    write_json(os.path.join(args.data_dir, "data_all.json"), new_data_all)
+
+    for name in OUTPUT_INDEXES:
+        write_json(
+            os.path.join(args.data_dir, f"data_{name}.json"),
+            [
+                dataset
+                for dataset in new_data_all
+                if in_output_dir(args, dataset, f"json_{name}")
+            ],
+        )
+
+
+def write_grants_streams(args, new_data_all):
+    """
+    Writes grants_all.ndjson, of the grants in every dataset in json_all, and
+    a grants_<name>.ndjson for each of the other output directories. Gzip and
+    zstd files can be joined end to end, so each dataset's grants are copied
+    in as they are, whether or not they're compressed.
+    """
+    for name in ["all"] + OUTPUT_INDEXES:
+        file_path = compression.compressed_name(
+            os.path.join(args.data_dir, f"grants_{name}.ndjson"), args.compress
+        )
+        tmp_file_path = f"{file_path}.tmp"
+
+        with open(tmp_file_path, "wb") as fp:
+            for dataset in new_data_all:
+                if not in_output_dir(args, dataset, f"json_{name}"):
+                    continue
+
+                grants_file = compression.find(grants_file_name(args, dataset))
+                if not grants_file:
+                    continue
+
+                # e.g. when resuming a run started with other --compress
+                grants_file = compression.recompress(grants_file, args.compress)
+                with open(grants_file, "rb") as grants_fp:
+                    shutil.copyfileobj(grants_fp, fp, compression.CHUNK_SIZE)
+
+        os.replace(tmp_file_path, file_path)
+
+
+def get(args):
+    start = time.perf_counter()
+
+    # Before the schemas, which are hashed by the cache's algorithm
+    try:
+        cache.setup_database(args.hash_algorithm)
         cache.setup_cache_dir()
     except cache.DatagetterCacheError as e:
         print(e)
         print("Continuing without cache")
 
+    base_url = "https://raw.githubusercontent.com/ThreeSixtyGiving/standard"
+    schema_path, schema_package_path = (
+        schema_store.fetch(
+            get_session(),
+            f"{base_url}/{args.schema_branch}/schema/{file_name}",
+            args.schema_branch,
+            args.offline,
+        )
+        for file_name in schema_store.SCHEMA_FILES
+    )
+
+    # Saves every process hashing the schemas to key the validation cache
+    stored_hashes = [
+        schema_store.content_hash(path) for path in [schema_path, schema_package_path]
+    ]
+    if None not in stored_hashes:
+        schema_hashes[(schema_path, schema_package_path)] = "-".join(stored_hashes)
+
+    # The last run's results, if the data dir is being reused
+    previous_data_all = []
+    try:
+        with open(os.path.join(args.data_dir, "data_all.json")) as fp:
+            previous_data_all = json.load(fp)
+    except (OSError, ValueError):
+        pass
+
+    # Resuming carries on in the existing data dir with the registry it fetched,
+    # and diffing the registry keeps the previous run's outputs for the datasets
+    # that haven't changed
+    mkdirs(args.data_dir, args.resume or args.registry_diff)
+    if args.registry_diff and not args.resume:
+        # The previous run's journal, which isn't this run's
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(os.path.join(args.data_dir, JOURNAL_FILE))
+    if args.grants_ndjson:
+        os.makedirs(os.path.join(args.data_dir, GRANTS_DIR), exist_ok=True)
+    data_original_path = os.path.join(args.data_dir, "data_original.json")
+
     if args.local_registry:
-        mkdirs(args.data_dir, False)
         with open(args.local_registry) as fp:
             data_all = json.load(fp)
+    elif args.resume and os.path.exists(data_original_path):
+        with open(data_original_path) as fp:
+            data_all = json.load(fp)
     else:
-        mkdirs(args.data_dir, False)
-
         # Try the registry 5 times to get valid data.json output
         # This guards against temporary downtime or other issues that the
         # registry might experience fetching the data.
         for i in range(0, 5):
             try:
-                res = session.get("https://registry.threesixtygiving.org/data.json")
+                res = get_session().get(
+                    "https://registry.threesixtygiving.org/data.json"
+                )
 
                 data_all = res.json()
                 if len(data_all) > 0:
@@ -457,32 +2175,225 @@ def get(args):
             )
             exit(1)
 
-    with Pool(args.threads) as process_pool:
-        new_data_all = []
-        # We iterate through data_all and return the object back with
-        # some datagetter_metadata added
-        data_metadata = process_pool.starmap(
-            fetch_and_convert,
-            zip(
-                itertools.repeat(args),
-                data_all,
-                itertools.repeat(schema_path),
-                itertools.repeat(schema_package_path),
-            ),
+    if args.shard:
+        shard_index, shard_count = args.shard
+        weights = shard.load_weights(args.shard_weights) if args.shard_weights else None
+        shard_positions = shard.positions(data_all, shard_index, shard_count, weights)
+        shard.write_shard_file(
+            args.data_dir,
+            shard_index,
+            shard_count,
+            shard_positions,
+            data_all,
+            args.compress,
         )
 
-        # Extra guard against "None" getting added to this list from an exception or
-        # rogue return
-        if data_metadata:
-            new_data_all += data_metadata
-
-    # Output data.json after every dataset, to help with debugging if we fail
-    # part way through
-    with open("%s/data_all.json" % args.data_dir, "w") as fp:
-        json.dump(new_data_all, fp, indent=4)
-    with open("%s/data_valid.json" % args.data_dir, "w") as fp:
-        json.dump(data_valid, fp, indent=4)
-    with open("%s/data_acceptable_license.json" % args.data_dir, "w") as fp:
-        json.dump(data_acceptable_license, fp, indent=4)
-    with open("%s/data_acceptable_license_valid.json" % args.data_dir, "w") as fp:
-        json.dump(data_acceptable_license_valid, fp, indent=4)
+        print(
+            f"Shard {shard_index} of {shard_count} has {len(shard_positions)} "
+            f"of the {len(data_all)} datasets"
+        )
+        data_all = [data_all[position] for position in shard_positions]
+
+    # Positions in the registry of the datasets that have finished processing
+    finished = {}
+
+    carried_forward, removed = {}, []
+    if args.registry_diff:
+        carried_forward, removed = diff_registry(args, data_all, previous_data_all)
+        finished.update(carried_forward)
+
+    if args.resume:
+        journal_finished = load_journal(args)
+        for index, dataset in enumerate(data_all):
+            if index in carried_forward:
+                continue
+            if dataset.get("identifier") in journal_finished:
+                finished[index] = journal_finished[dataset.get("identifier")]
+            else:
+                remove_partial_outputs(args, dataset)
+
+        print(f"Resuming, {len(finished)} of {len(data_all)} datasets already finished")
+
+    jobs = [
+        (index, dataset)
+        for index, dataset in enumerate(data_all)
+        if index not in finished
+    ]
+
+    semaphores = host_semaphores_for(
+        data_all, args.host_concurrency, pool_context(args)
+    )
+
+    if args.schedule == "size":
+        jobs = longest_first(args, jobs, previous_data_all, semaphores)
+
+    if args.pipeline:
+        configure_downloads(semaphores, args.host_concurrency)
+        results = run_pipeline(args, jobs, schema_path, schema_package_path)
+    else:
+        results = run_pool(args, jobs, schema_path, schema_package_path, semaphores)
+
+    # The metrics of the datasets processed this run, by identifier
+    metrics_by_identifier = {}
+
+    index_con = None
+    if args.grants_index:
+        try:
+            index_con = grants_index.connect(
+                os.path.join(args.data_dir, grants_index.DATABASE_NAME)
+            )
+        except grants_index.GrantsIndexError as e:
+            print(f"Continuing without grants index: {e}")
+
+    if args.registry_diff and (args.grants_ndjson or index_con):
+        carry_forward_grants(args, carried_forward.values(), index_con, removed)
+
+    # Record each dataset as it finishes, so that a crash part way through
+    # doesn't lose the work done so far (see --resume)
+    with open(os.path.join(args.data_dir, JOURNAL_FILE), "a") as journal:
+        for index, dataset in results:
+            # Extra guard against "None" getting added from an exception or
+            # rogue return
+            if not dataset:
+                continue
+
+            dataset_metrics = dataset.pop(metrics.METRICS_KEY, None)
+            if dataset_metrics:
+                metrics_by_identifier[dataset.get("identifier")] = dataset_metrics
+
+            # Only this process writes to the grants index, so workers never
+            # wait on each other for it
+            grant_rows = dataset.pop(grants_index.ROWS_KEY, None)
+            if index_con:
+                try:
+                    grants_index.add_dataset(index_con, dataset, grant_rows)
+                except grants_index.GrantsIndexError as e:
+                    print(f"Could not index the grants of {dataset['identifier']}: {e}")
+
+            finished[index] = dataset
+            journal.write(json.dumps({"index": index, "dataset": dataset}) + "\n")
+            journal.flush()
+
+    # The indexes are in registry order regardless of the order datasets finished
+    new_data_all = [finished[index] for index in sorted(finished)]
+    write_indexes(args, new_data_all)
+    if args.grants_ndjson:
+        write_grants_streams(args, new_data_all)
+    if index_con:
+        try:
+            grants_index.finish(index_con)
+        except grants_index.GrantsIndexError as e:
+            print(f"Could not finish the grants index: {e}")
+    record_history(new_data_all, metrics_by_identifier)
+
+    summary = metrics.summarise(metrics_by_identifier, time.perf_counter() - start)
+    metrics.write_summary(os.path.join(args.data_dir, METRICS_FILE), summary)
+    if args.metrics_prometheus:
+        metrics.write_prometheus(args.metrics_prometheus, summary)
+
+    if args.cache_max_bytes is not None or args.cache_max_age is not None:
+        try:
+            print(cache.gc(args.cache_max_bytes, args.cache_max_age))
+        except cache.DatagetterCacheError as e:
+            print(f"Cache eviction failed: {e}")
+
+
+def merge(args):
+    """
+    Combines the data dirs of a sharded run (see getter.shard) into
+    args.data_dir, linking in their outputs and writing the indexes, grants
+    outputs and metrics for them all. Raises shard.ShardError.
+    """
+    shards = shard.load_shards(args.shard_dirs)
+
+    shard_data_alls = []
+    for shard_dir in args.shard_dirs:
+        try:
+            with open(os.path.join(shard_dir, "data_all.json")) as fp:
+                shard_data_alls.append(json.load(fp))
+        except (OSError, ValueError) as e:
+            raise shard.ShardError(f"Could not read the datasets of {shard_dir}: {e}")
+    shard.check_identifiers(shards, shard_data_alls)
+
+    # The grants streams are written with the shards' compression
+    if args.compress is None:
+        args.compress = shards[0]["compress"]
+
+    mkdirs(args.data_dir)
+    output_dirs = ["original", "json_all"] + [f"json_{name}" for name in OUTPUT_INDEXES]
+
+    merged = []
+    metrics_by_identifier = {}
+    wall_time = 0
+    grants_ndjson = False
+
+    index_con = None
+    if any(
+        os.path.exists(os.path.join(shard_dir, grants_index.DATABASE_NAME))
+        for shard_dir in args.shard_dirs
+    ):
+        try:
+            index_con = grants_index.connect(
+                os.path.join(args.data_dir, grants_index.DATABASE_NAME)
+            )
+        except grants_index.GrantsIndexError as e:
+            print(f"Continuing without grants index: {e}")
+
+    for shard_dir, shard_info, data_all in zip(
+        args.shard_dirs, shards, shard_data_alls
+    ):
+        print(f"Merging shard {shard_info['index']} from {shard_dir}")
+
+        for position, dataset in zip(shard_info["positions"], data_all):
+            metadata = dataset.get("datagetter_metadata", {})
+            if metadata.get("json"):
+                metadata["json"] = os.path.join(
+                    args.data_dir, "json_all", os.path.basename(metadata["json"])
+                )
+            merged.append((position, dataset))
+
+        if os.path.isdir(os.path.join(shard_dir, GRANTS_DIR)):
+            grants_ndjson = True
+            os.makedirs(os.path.join(args.data_dir, GRANTS_DIR), exist_ok=True)
+
+        for dir_name in output_dirs + [GRANTS_DIR]:
+            shard_output_dir = os.path.join(shard_dir, dir_name)
+            if not os.path.isdir(shard_output_dir):
+                continue
+            for file_name in os.listdir(shard_output_dir):
+                cache.link_file(
+                    os.path.join(shard_output_dir, file_name),
+                    os.path.join(args.data_dir, dir_name, file_name),
+                )
+
+        try:
+            with open(os.path.join(shard_dir, METRICS_FILE)) as fp:
+                shard_metrics = json.load(fp)
+            metrics_by_identifier.update(shard_metrics["dataset_metrics"])
+            wall_time = max(wall_time, shard_metrics["wall_time"])
+        except (OSError, ValueError, KeyError):
+            print(f"Warning: No metrics for shard {shard_info['index']}")
+
+        shard_database = os.path.join(shard_dir, grants_index.DATABASE_NAME)
+        if index_con and os.path.exists(shard_database):
+            try:
+                grants_index.merge(index_con, shard_database)
+            except grants_index.GrantsIndexError as e:
+                print(f"Could not merge the grants index of {shard_dir}: {e}")
+
+    # Back in registry order, as if it had been the one run
+    new_data_all = [dataset for _, dataset in sorted(merged, key=lambda item: item[0])]
+    write_indexes(args, new_data_all)
+    if grants_ndjson:
+        write_grants_streams(args, new_data_all)
+    if index_con:
+        try:
+            grants_index.finish(index_con)
+        except grants_index.GrantsIndexError as e:
+            print(f"Could not finish the grants index: {e}")
+
+    # The wall time is the longest shard's, as they run side by side
+    summary = metrics.summarise(metrics_by_identifier, wall_time)
+    metrics.write_summary(os.path.join(args.data_dir, METRICS_FILE), summary)
+
+    print(f"Merged {len(new_data_all)} datasets from {len(shards)} shards")
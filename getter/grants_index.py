@@ -0,0 +1,199 @@
+"""
+An SQLite index of the grants in a run's datasets, written to the data dir
+with --grants-index. e.g. which datasets have grant id X:
+
+    SELECT dataset_identifier FROM grants WHERE grant_id = ?
+
+The workers pull the indexed fields out of each dataset's grants while they
+have its JSON parsed (see grant_rows) and get() adds them to the database as
+the datasets finish, so there's only the one writer.
+"""
+import apsw
+
+DATABASE_NAME = "grants_index.db"
+
+# Key the rows are carried under in a dataset on the way back from a worker.
+# get() removes it before the dataset is written to the data_*.json indexes.
+ROWS_KEY = "datagetter_grants_index"
+
+# Milliseconds to wait if something else is reading the database
+BUSY_TIMEOUT = 30000
+
+
+class GrantsIndexError(Exception):
+    pass
+
+
+def org_id(grant, field):
+    orgs = grant.get(field)
+    if isinstance(orgs, list) and orgs and isinstance(orgs[0], dict):
+        return orgs[0].get("id")
+    return None
+
+
+def grant_rows(data):
+    """Returns the (grant id, recipient, funder, amount, award date) of each grant"""
+    grants = data.get("grants") if isinstance(data, dict) else None
+    rows = []
+
+    for grant in grants or []:
+        if not isinstance(grant, dict):
+            continue
+
+        amount = grant.get("amountAwarded")
+        rows.append(
+            (
+                grant.get("id"),
+                org_id(grant, "recipientOrganization"),
+                org_id(grant, "fundingOrganization"),
+                amount if isinstance(amount, (int, float)) else None,
+                grant.get("awardDate"),
+            )
+        )
+
+    return rows
+
+
+def connect(database_file):
+    """Opens (or creates) the grants index. Raises GrantsIndexError."""
+    try:
+        con = apsw.Connection(database_file)
+        con.setbusytimeout(BUSY_TIMEOUT)
+        cur = con.cursor()
+        cur.execute("PRAGMA journal_mode = WAL")
+        cur.execute("PRAGMA synchronous = NORMAL")
+
+        cur.execute(
+            """CREATE TABLE IF NOT EXISTS datasets
+            (identifier TEXT NOT NULL PRIMARY KEY,
+            publisher_prefix TEXT,
+            valid INTEGER NOT NULL,
+            acceptable_license INTEGER NOT NULL);"""
+        )
+        cur.execute(
+            """CREATE TABLE IF NOT EXISTS grants
+            (grant_id TEXT,
+            dataset_identifier TEXT NOT NULL,
+            recipient_org_id TEXT,
+            funding_org_id TEXT,
+            amount_awarded REAL,
+            award_date TEXT);"""
+        )
+        # For finding the grants that appear in more than one dataset
+        cur.execute(
+            """CREATE VIEW IF NOT EXISTS duplicate_grant_ids AS
+            SELECT grant_id, COUNT(DISTINCT dataset_identifier) AS datasets
+            FROM grants GROUP BY grant_id
+            HAVING COUNT(DISTINCT dataset_identifier) > 1;"""
+        )
+        # Replacing a dataset's rows needs this while the run goes on
+        cur.execute(
+            """CREATE INDEX IF NOT EXISTS grants_dataset_identifier
+            ON grants (dataset_identifier);"""
+        )
+
+        return con
+    except Exception as e:
+        raise GrantsIndexError(e)
+
+
+def add_dataset(con, dataset, rows):
+    """
+    Replaces the rows of the dataset (e.g. from an interrupted run) in one
+    transaction. Raises GrantsIndexError.
+    """
+    identifier = dataset["identifier"]
+    metadata = dataset.get("datagetter_metadata", {})
+
+    try:
+        with con:
+            cur = con.cursor()
+            cur.execute(
+                "DELETE FROM grants WHERE dataset_identifier = ?", (identifier,)
+            )
+            cur.execute(
+                "INSERT OR REPLACE INTO datasets VALUES (?, ?, ?, ?)",
+                (
+                    identifier,
+                    dataset.get("publisher", {}).get("prefix"),
+                    bool(metadata.get("valid")),
+                    bool(metadata.get("acceptable_license")),
+                ),
+            )
+            if rows:
+                cur.executemany(
+                    "INSERT INTO grants VALUES (?, ?, ?, ?, ?, ?)",
+                    (
+                        (grant_id, identifier, recipient, funder, amount, award_date)
+                        for grant_id, recipient, funder, amount, award_date in rows
+                    ),
+                )
+    except Exception as e:
+        raise GrantsIndexError(e)
+
+
+def remove_datasets(con, identifiers):
+    """Removes the datasets and their rows. Raises GrantsIndexError."""
+    try:
+        with con:
+            cur = con.cursor()
+            for identifier in identifiers:
+                cur.execute(
+                    "DELETE FROM grants WHERE dataset_identifier = ?", (identifier,)
+                )
+                cur.execute("DELETE FROM datasets WHERE identifier = ?", (identifier,))
+    except Exception as e:
+        raise GrantsIndexError(e)
+
+
+def dataset_identifiers(con):
+    """Returns the identifiers of the datasets in the index. Raises GrantsIndexError."""
+    try:
+        return {
+            row[0] for row in con.cursor().execute("SELECT identifier FROM datasets")
+        }
+    except Exception as e:
+        raise GrantsIndexError(e)
+
+
+def merge(con, database_file):
+    """
+    Adds the datasets and grants of another grants index (e.g. a shard's),
+    replacing any it has in common. Raises GrantsIndexError.
+    """
+    try:
+        cur = con.cursor()
+        cur.execute("ATTACH DATABASE ? AS other", (database_file,))
+        try:
+            with con:
+                cur.execute(
+                    """DELETE FROM grants WHERE dataset_identifier IN
+                    (SELECT identifier FROM other.datasets)"""
+                )
+                cur.execute(
+                    "INSERT OR REPLACE INTO datasets SELECT * FROM other.datasets"
+                )
+                cur.execute("INSERT INTO grants SELECT * FROM other.grants")
+        finally:
+            cur.execute("DETACH DATABASE other")
+    except Exception as e:
+        raise GrantsIndexError(e)
+
+
+def finish(con):
+    """
+    Adds the lookup indexes, which is quicker once than on every insert, and
+    closes the database. Raises GrantsIndexError.
+    """
+    try:
+        cur = con.cursor()
+        for column in ["grant_id", "recipient_org_id", "funding_org_id"]:
+            cur.execute(
+                f"CREATE INDEX IF NOT EXISTS grants_{column} ON grants ({column})"
+            )
+        cur.execute("ANALYZE")
+        # Leaves the one file, without the -wal and -shm
+        cur.execute("PRAGMA journal_mode = DELETE")
+        con.close()
+    except Exception as e:
+        raise GrantsIndexError(e)
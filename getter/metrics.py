@@ -0,0 +1,163 @@
+import contextlib
+import json
+import os
+import time
+
+# Key the metrics are carried under in a dataset while it's being processed.
+# get() removes it before the dataset is written to the data_*.json indexes.
+METRICS_KEY = "datagetter_metrics"
+
+PHASES = [
+    "download",
+    "hash",
+    "cache_lookup",
+    "conversion",
+    "extension_resolution",
+    "validation",
+]
+
+CACHES = ["conversion", "validation"]
+
+# Number of datasets listed in the summary's slowest_datasets
+SLOWEST_DATASETS = 20
+
+
+def dataset_metrics(dataset):
+    """Returns the metrics being recorded for a dataset, creating them if needed"""
+    return dataset.setdefault(
+        METRICS_KEY, {"timings": {}, "bytes_downloaded": 0, "cache_hits": {}}
+    )
+
+
+def add_time(metrics, phase, seconds):
+    if metrics is not None:
+        timings = metrics["timings"]
+        timings[phase] = timings.get(phase, 0) + seconds
+
+
+@contextlib.contextmanager
+def timed(metrics, phase):
+    """Adds the wall time spent in the block to the metrics for phase"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_time(metrics, phase, time.perf_counter() - start)
+
+
+def cache_hit(metrics, cache_name, hit):
+    if metrics is not None:
+        metrics["cache_hits"][cache_name] = hit
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of values"""
+    if not values:
+        return None
+
+    values = sorted(values)
+    return values[max(0, int(round(fraction * len(values))) - 1)]
+
+
+def summarise(metrics_by_identifier, wall_time):
+    """Summarises the metrics of every dataset processed in a run"""
+    all_metrics = list(metrics_by_identifier.values())
+    bytes_downloaded = sum(metrics["bytes_downloaded"] for metrics in all_metrics)
+
+    phases = {}
+    for phase in PHASES + ["total"]:
+        timings = [
+            metrics["timings"][phase]
+            for metrics in all_metrics
+            if phase in metrics["timings"]
+        ]
+        phases[phase] = {
+            "count": len(timings),
+            "sum": sum(timings),
+            "p50": percentile(timings, 0.5),
+            "p95": percentile(timings, 0.95),
+            "max": max(timings, default=None),
+        }
+
+    cache_hit_rate = {}
+    for cache_name in CACHES:
+        lookups = [
+            metrics["cache_hits"][cache_name]
+            for metrics in all_metrics
+            if cache_name in metrics["cache_hits"]
+        ]
+        cache_hit_rate[cache_name] = sum(lookups) / len(lookups) if lookups else None
+
+    slowest = sorted(
+        metrics_by_identifier.items(),
+        key=lambda item: item[1]["timings"].get("total", 0),
+        reverse=True,
+    )[:SLOWEST_DATASETS]
+
+    return {
+        "datasets": len(all_metrics),
+        "wall_time": wall_time,
+        "bytes_downloaded": bytes_downloaded,
+        "datasets_per_second": len(all_metrics) / wall_time if wall_time else None,
+        "bytes_per_second": bytes_downloaded / wall_time if wall_time else None,
+        "phases": phases,
+        "cache_hit_rate": cache_hit_rate,
+        "slowest_datasets": [
+            {"identifier": identifier, **metrics} for identifier, metrics in slowest
+        ],
+        "dataset_metrics": metrics_by_identifier,
+    }
+
+
+def write_prometheus(file_path, summary):
+    """
+    Writes the summary in the Prometheus textfile collector format, via a
+    temporary file as the collector may read it at any time
+    """
+    lines = [
+        "# HELP datagetter_run_seconds Wall time of the datagetter run",
+        "# TYPE datagetter_run_seconds gauge",
+        f"datagetter_run_seconds {summary['wall_time']}",
+        "# HELP datagetter_datasets Datasets processed by the datagetter run",
+        "# TYPE datagetter_datasets gauge",
+        f"datagetter_datasets {summary['datasets']}",
+        "# HELP datagetter_downloaded_bytes Bytes downloaded by the datagetter run",
+        "# TYPE datagetter_downloaded_bytes gauge",
+        f"datagetter_downloaded_bytes {summary['bytes_downloaded']}",
+        "# HELP datagetter_phase_seconds Time spent per dataset in each phase",
+        "# TYPE datagetter_phase_seconds summary",
+    ]
+
+    for phase, stats in summary["phases"].items():
+        for key, quantile in [("p50", "0.5"), ("p95", "0.95")]:
+            if stats[key] is not None:
+                lines.append(
+                    f'datagetter_phase_seconds{{phase="{phase}",quantile="{quantile}"}} '
+                    f"{stats[key]}"
+                )
+        lines.append(f'datagetter_phase_seconds_sum{{phase="{phase}"}} {stats["sum"]}')
+        lines.append(
+            f'datagetter_phase_seconds_count{{phase="{phase}"}} {stats["count"]}'
+        )
+
+    lines += [
+        "# HELP datagetter_cache_hit_ratio Fraction of cache lookups that hit",
+        "# TYPE datagetter_cache_hit_ratio gauge",
+    ]
+    for cache_name, hit_rate in summary["cache_hit_rate"].items():
+        if hit_rate is not None:
+            lines.append(
+                f'datagetter_cache_hit_ratio{{cache="{cache_name}"}} {hit_rate}'
+            )
+
+    tmp_file_path = f"{file_path}.tmp"
+    with open(tmp_file_path, "w") as fp:
+        fp.write("\n".join(lines) + "\n")
+    os.replace(tmp_file_path, file_path)
+
+
+def write_summary(file_path, summary):
+    tmp_file_path = f"{file_path}.tmp"
+    with open(tmp_file_path, "w") as fp:
+        json.dump(summary, fp, indent=4)
+    os.replace(tmp_file_path, file_path)
@@ -0,0 +1,191 @@
+"""
+Keeps the last good copy of each 360Giving schema file for each schema branch
+in STORE_DIR, so the schemas are only downloaded again when they've changed
+(going by their ETag/Last-Modified) and a run can carry on with the stored
+copy if GitHub can't be reached, or use it without asking with --offline.
+
+Each branch's directory has a metadata.json recording the url, HTTP
+validators, content hash (by the cache's algorithm) and fetch time of each of
+its files.
+"""
+import json
+import os
+import time
+from urllib.parse import quote
+
+import getter.cache as cache
+
+STORE_DIR = "schema_store"
+METADATA_FILE = "metadata.json"
+
+# The files of each branch, in the order their hashes are joined to key the
+# cached validations (see get.schema_files_hash)
+SCHEMA_FILES = ["360-giving-schema.json", "360-giving-package-schema.json"]
+
+# Attempts at fetching a schema file before falling back to the stored copy
+ATTEMPTS = 3
+# Seconds before the first retry, doubling for each one after
+RETRY_DELAY = 1
+
+
+class SchemaStoreError(Exception):
+    pass
+
+
+def branch_dir(schema_branch):
+    # Branch names can have slashes in
+    return os.path.join(STORE_DIR, quote(schema_branch, safe=""))
+
+
+def load_metadata(store_dir):
+    try:
+        with open(os.path.join(store_dir, METADATA_FILE)) as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_metadata(store_dir, metadata):
+    file_path = os.path.join(store_dir, METADATA_FILE)
+    tmp_file_path = f"{file_path}.tmp"
+    with open(tmp_file_path, "w") as fp:
+        json.dump(metadata, fp, indent=4)
+    os.replace(tmp_file_path, file_path)
+
+
+def content_hash(file_path):
+    """
+    Returns the content hash recorded for a stored schema file, or None if
+    there isn't one by the algorithm the cache is keyed with
+    """
+    store_dir, file_name = os.path.split(file_path)
+    entry = load_metadata(store_dir).get(file_name, {})
+
+    if entry.get("hash_algorithm") != cache.current_hash_algorithm():
+        return None
+    return entry.get("hash")
+
+
+def update_hash(store_dir, metadata, file_name):
+    """Rehashes a stored file if it was hashed with another algorithm"""
+    entry = metadata[file_name]
+    if entry.get("hash_algorithm") == cache.current_hash_algorithm():
+        return
+
+    try:
+        entry["hash"] = cache.hash_file(os.path.join(store_dir, file_name))
+        entry["hash_algorithm"] = cache.current_hash_algorithm()
+        write_metadata(store_dir, metadata)
+    except (OSError, cache.DatagetterCacheError) as e:
+        print(f"Could not hash {file_name}: {e}")
+
+
+def conditional_get(session, url, entry):
+    """GETs url, conditional on the stored copy's validators. Returns the response"""
+    headers = {}
+    if entry.get("etag"):
+        headers["If-None-Match"] = entry["etag"]
+    if entry.get("last_modified"):
+        headers["If-Modified-Since"] = entry["last_modified"]
+
+    for attempt in range(ATTEMPTS):
+        try:
+            res = session.get(url, headers=headers, timeout=60)
+            res.raise_for_status()
+            return res
+        except Exception as e:
+            if attempt == ATTEMPTS - 1:
+                raise
+            print(f"Retrying {url}: {e}")
+            time.sleep(RETRY_DELAY * 2**attempt)
+
+
+def fetch(session, url, schema_branch, offline=False):
+    """
+    Returns the path of the stored copy of the schema file at url, first
+    updating it from url unless offline. Raises SchemaStoreError if there's
+    no copy to use.
+    """
+    store_dir = os.path.abspath(branch_dir(schema_branch))
+    file_name = os.path.basename(url)
+    file_path = os.path.join(store_dir, file_name)
+
+    metadata = load_metadata(store_dir)
+    entry = metadata.get(file_name, {})
+    stored = bool(entry) and os.path.exists(file_path)
+
+    if offline:
+        if not stored:
+            raise SchemaStoreError(
+                f"No stored copy of {file_name} for schema branch {schema_branch}"
+            )
+        print(f"Using stored {file_path} from {time.ctime(entry['fetched'])}")
+        update_hash(store_dir, metadata, file_name)
+        return file_path
+
+    try:
+        res = conditional_get(session, url, entry if stored else {})
+
+        if res.status_code == 304:
+            update_hash(store_dir, metadata, file_name)
+            return file_path
+
+        # Don't replace a good copy with e.g. an error page
+        json.loads(res.content)
+
+        os.makedirs(store_dir, exist_ok=True)
+        tmp_file_path = f"{file_path}.tmp"
+        with open(tmp_file_path, "wb") as fp:
+            fp.write(res.content)
+        os.replace(tmp_file_path, file_path)
+
+        print(f"Stored {url} in {file_path}")
+
+        metadata[file_name] = {
+            "url": url,
+            "etag": res.headers.get("ETag"),
+            "last_modified": res.headers.get("Last-Modified"),
+            "hash": cache.hash_file(file_path),
+            "hash_algorithm": cache.current_hash_algorithm(),
+            "fetched": time.time(),
+        }
+        write_metadata(store_dir, metadata)
+    except Exception as e:
+        if not stored:
+            raise SchemaStoreError(f"Couldn't fetch {url}: {e}")
+
+        print(
+            f"Couldn't fetch {url} ({e}), "
+            f"using stored copy from {time.ctime(entry['fetched'])}"
+        )
+        update_hash(store_dir, metadata, file_name)
+
+    return file_path
+
+
+def schema_hash_changes(previous_algorithm, algorithm):
+    """
+    Returns the hash of each branch's stored schemas by algorithm, keyed by
+    their hash by previous_algorithm, for rekeying the cache (see
+    cache.migrate_hashes). Branches whose schemas can't be hashed are left out.
+    """
+    changes = {}
+    if not os.path.isdir(STORE_DIR):
+        return changes
+
+    for dir_name in os.listdir(STORE_DIR):
+        file_paths = [
+            os.path.abspath(os.path.join(STORE_DIR, dir_name, file_name))
+            for file_name in SCHEMA_FILES
+        ]
+        try:
+            previous_hash, new_hash = (
+                "-".join(cache.hash_file(path, hash_algorithm) for path in file_paths)
+                for hash_algorithm in [previous_algorithm, algorithm]
+            )
+        except cache.DatagetterCacheError:
+            continue
+
+        changes[previous_hash] = new_hash
+
+    return changes
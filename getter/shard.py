@@ -0,0 +1,170 @@
+"""
+Splits the registry between several runs (e.g. on different machines) with
+--shard INDEX/COUNT. Each run processes its share of the datasets into its
+own data dir, and `datagetter.py merge` combines those data dirs into one.
+
+By default a dataset's shard is a stable hash of its identifier, so every
+run agrees on it without coordinating. With --shard-weights the datasets are
+instead balanced between the shards by their size in a previous run, which
+needs every run to use the same registry (e.g. with --local-registry).
+"""
+import hashlib
+import json
+import os
+import statistics
+
+# Written to each shard's data dir for merge to check and order the datasets by
+SHARD_FILE = "shard.json"
+
+
+class ShardError(Exception):
+    pass
+
+
+def stable_hash(identifier):
+    """Unlike hash(), the same in every process and on every machine"""
+    digest = hashlib.blake2b(str(identifier).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big")
+
+
+def load_weights(file_path):
+    """
+    Returns the file size of each dataset in a previous run's data_all.json.
+    Raises ShardError.
+    """
+    try:
+        with open(file_path) as fp:
+            data_all = json.load(fp)
+    except (OSError, ValueError) as e:
+        raise ShardError(f"Could not read the shard weights: {e}")
+
+    return {
+        dataset.get("identifier"): dataset["datagetter_metadata"]["file_size"]
+        for dataset in data_all
+        if dataset.get("datagetter_metadata", {}).get("file_size")
+    }
+
+
+def weighted_shards(identifiers, weights, count):
+    """
+    Returns the shard of each identifier, giving each (heaviest first) to the
+    shard with the least weight so far. Identifiers without a weight count as
+    the median weight.
+    """
+    default = statistics.median(weights.values()) if weights else 1
+    loads = [0] * count
+    shards = {}
+
+    for identifier in sorted(
+        set(identifiers),
+        key=lambda identifier: (
+            -weights.get(identifier, default),
+            stable_hash(identifier),
+        ),
+    ):
+        shard = min(range(count), key=lambda shard: loads[shard])
+        shards[identifier] = shard
+        loads[shard] += weights.get(identifier, default)
+
+    return shards
+
+
+def positions(data_all, index, count, weights=None):
+    """Returns the positions in data_all of the datasets in shard index of count"""
+    identifiers = [dataset.get("identifier") for dataset in data_all]
+
+    if weights is None:
+        shards = {
+            identifier: stable_hash(identifier) % count for identifier in identifiers
+        }
+    else:
+        shards = weighted_shards(identifiers, weights, count)
+
+    return [
+        position
+        for position, identifier in enumerate(identifiers)
+        if shards[identifier] == index
+    ]
+
+
+def registry_digest(data_all):
+    """
+    Returns a hash of the datasets' identifiers and download URLs in registry
+    order, which the shards of one run all share
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for dataset in data_all:
+        distribution = (dataset.get("distribution") or [{}])[0]
+        digest.update(
+            json.dumps(
+                [dataset.get("identifier"), distribution.get("downloadURL")]
+            ).encode()
+        )
+    return digest.hexdigest()
+
+
+def write_shard_file(data_dir, index, count, shard_positions, data_all, compress):
+    with open(os.path.join(data_dir, SHARD_FILE), "w") as fp:
+        json.dump(
+            {
+                "index": index,
+                "count": count,
+                "positions": shard_positions,
+                "registry_size": len(data_all),
+                "registry_digest": registry_digest(data_all),
+                "compress": compress,
+            },
+            fp,
+            indent=4,
+        )
+
+
+def load_shards(shard_dirs):
+    """
+    Returns the shard file of each data dir, checking they're from the same
+    sharded run. Raises ShardError.
+    """
+    shards = []
+    for shard_dir in shard_dirs:
+        try:
+            with open(os.path.join(shard_dir, SHARD_FILE)) as fp:
+                shards.append(json.load(fp))
+        except (OSError, ValueError) as e:
+            raise ShardError(f"{shard_dir} isn't the data dir of a shard: {e}")
+
+    counts = {shard["count"] for shard in shards}
+    if len(counts) > 1:
+        raise ShardError(f"The shards are from runs with different counts {counts}")
+
+    # Positions only line up between runs of the same registry
+    registries = {
+        (shard.get("registry_size"), shard.get("registry_digest")) for shard in shards
+    }
+    if len(registries) > 1:
+        raise ShardError("The shards are from runs of different registries")
+
+    indexes = [shard["index"] for shard in shards]
+    if len(set(indexes)) < len(indexes):
+        raise ShardError(f"The same shard is given more than once {indexes}")
+
+    missing = set(range(counts.pop())) - set(indexes)
+    if missing:
+        print(f"Warning: Merging without shards {sorted(missing)}")
+
+    return shards
+
+
+def check_identifiers(shards, shard_data_alls):
+    """
+    Checks no dataset is in more than one shard, e.g. from runs with different
+    --shard-weights. Raises ShardError.
+    """
+    shard_by_identifier = {}
+    for shard, data_all in zip(shards, shard_data_alls):
+        for dataset in data_all:
+            identifier = dataset.get("identifier")
+            other = shard_by_identifier.setdefault(identifier, shard["index"])
+            if other != shard["index"]:
+                raise ShardError(
+                    f"{identifier} is in both shard {other} and shard {shard['index']}"
+                )
@@ -1,4 +1,6 @@
 import json
+import apsw
+import multiprocessing
 import pytest
 import http.server
 import socketserver
@@ -6,8 +8,29 @@ import os
 import threading
 import time
 import shutil
-from getter.get import get
+import subprocess
+import sys
+import types
+from getter.get import (
+    ChunkValidator,
+    RecyclingPool,
+    ValidationError,
+    chunk_errors,
+    configure_validation,
+    get,
+    get_schema_360,
+    get_session,
+    grant_index,
+    load_json,
+    merge,
+    validate,
+    validate_chunks,
+)
 import getter.cache as cache
+import getter.get
+import getter.compression as compression
+import getter.schema_store as schema_store
+import getter.shard as shard
 
 TEST_DATA_DIR = os.path.join(os.path.dirname(__file__), "data")
 TEST_SERVER_PORT = 8888  # this is what the registry.json urls are expecting
@@ -57,24 +80,62 @@ class DatagetterArgs(object):
     local_registry = os.path.join(TEST_DATA_DIR, "input", "registry.json")
     download = True
     schema_branch = "main"
+    offline = False
     threads = 1
+    pipeline = False
+    download_concurrency = 2
+    workers = 1
+    host_concurrency = 1
+    max_tasks_per_child = None
+    worker_max_rss = None
+    large_file_size = None
+    large_file_workers = 1
+    validation_chunk_size = None
+    validation_workers = 2
+    schedule = "size"
+    head_sizes = False
+    head_concurrency = 2
+    incremental = False
+    registry_diff = False
+    shard = None
+    shard_weights = None
+    resume = False
+    compress = None
+    grants_ndjson = False
+    grants_index = False
+    hash_algorithm = None
+    cache_max_bytes = None
+    cache_max_age = None
+    metrics_prometheus = None
     data_dir = os.path.join(TEST_DATA_DIR, "fetched_output")
 
 
-def test_expected_output(test_server):
-    getter_args = DatagetterArgs()
+def remove_known_differences(item):
+    """
+    Removes timestamp and full path which will be different
+    depending on when/where this test is being run
+    """
+    del item["datagetter_metadata"]["datetime_downloaded"]
+    if json_path := item["datagetter_metadata"].get("json"):
+        item["datagetter_metadata"]["json"] = os.path.basename(
+            compression.uncompressed_name(json_path)
+        )
+
+    return item
+
+
+def run_getter(getter_args):
     # remove any existing data
     try:
         shutil.rmtree(getter_args.data_dir)
     except FileNotFoundError:
         pass
 
-    cache.delete_cache()
-
     # Run the datagetter
     get(getter_args)
 
-    # produces
+
+def assert_expected_output():
     expected_data_dir = os.path.join(TEST_DATA_DIR, "expected_output")
     fetched_output_dir = os.path.join(TEST_DATA_DIR, "fetched_output")
 
@@ -85,17 +146,6 @@ def test_expected_output(test_server):
         open(os.path.join(expected_data_dir, "data_all.json"))
     )
 
-    def remove_known_differences(item):
-        """
-        Removes timestamp and full path which will be different
-        depending on when/where this test is being run
-        """
-        del item["datagetter_metadata"]["datetime_downloaded"]
-        if json_path := item["datagetter_metadata"].get("json"):
-            item["datagetter_metadata"]["json"] = os.path.basename(json_path)
-
-        return item
-
     # Remove known differences
     expected_data_all = [remove_known_differences(item) for item in expected_data_all]
     fetched_data_all = [remove_known_differences(item) for item in fetched_data_all]
@@ -103,8 +153,885 @@ def test_expected_output(test_server):
     # Check data_all's match
     assert fetched_data_all == expected_data_all
 
+    # Check the other indexes list the same datasets
+    for name in ["valid", "acceptable_license", "acceptable_license_valid"]:
+        index_file = f"data_{name}.json"
+        expected = json.load(open(os.path.join(expected_data_dir, index_file)))
+        fetched = json.load(open(os.path.join(fetched_output_dir, index_file)))
+        assert [item["identifier"] for item in fetched] == [
+            item["identifier"] for item in expected
+        ]
+
     # Compare other files produced with the expected files
     for file in ["aninvalidfile.json", "conversionerrorsfile.json", "validfile.json"]:
         expected = json.load(open(os.path.join(expected_data_dir, "json_all", file)))
-        fetched = json.load(open(os.path.join(fetched_output_dir, "json_all", file)))
+        fetched_file = compression.find(
+            os.path.join(fetched_output_dir, "json_all", file)
+        )
+        with compression.open_file(fetched_file) as fp:
+            fetched = json.load(fp)
         assert fetched == expected
+
+
+def assert_not_downloaded():
+    """
+    The spreadsheets were unmodified (a 304) so were restored from the last run,
+    without being downloaded, converted or validated again
+    """
+    with open(os.path.join(TEST_DATA_DIR, "fetched_output", "metrics.json")) as fp:
+        dataset_metrics = json.load(fp)["dataset_metrics"]
+
+    for identifier in ["aninvalidfile", "conversionerrorsfile", "validfile"]:
+        assert dataset_metrics[identifier]["bytes_downloaded"] == 0
+        assert "conversion" not in dataset_metrics[identifier]["timings"]
+        assert "validation" not in dataset_metrics[identifier]["timings"]
+
+
+def test_lazy_imports():
+    """The conversion/validation libraries aren't imported until they're needed"""
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import getter.get, sys; "
+            "print(' '.join(name for name in sys.modules "
+            "if name.split('.')[0] in ['lib360dataquality', 'libcove', 'flattentool']))",
+        ],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+    assert result.stdout.strip() == ""
+
+
+def test_expected_output(test_server):
+    cache.delete_cache()
+
+    run_getter(DatagetterArgs())
+
+    assert_expected_output()
+
+    # Every dataset is timed, without the metrics being left in data_all.json
+    fetched_output_dir = os.path.join(TEST_DATA_DIR, "fetched_output")
+    data_all = json.load(open(os.path.join(fetched_output_dir, "data_all.json")))
+    run_metrics = json.load(open(os.path.join(fetched_output_dir, "metrics.json")))
+    assert run_metrics["datasets"] == len(data_all)
+    assert run_metrics["phases"]["download"]["count"] > 0
+
+
+def test_incremental_output(test_server):
+    """Second run gets 304s from the test server and reuses the first run's outputs"""
+    cache.delete_cache()
+
+    getter_args = DatagetterArgs()
+    getter_args.incremental = True
+
+    run_getter(getter_args)
+    assert_expected_output()
+
+    run_getter(getter_args)
+    assert_expected_output()
+    assert_not_downloaded()
+
+
+def test_incremental_schema_change(test_server):
+    """Outcomes recorded against other schemas aren't reused for a 304"""
+    cache.delete_cache()
+
+    getter_args = DatagetterArgs()
+    getter_args.incremental = True
+
+    run_getter(getter_args)
+
+    # As if the schemas had changed since, and found every dataset invalid
+    cache.connect().cursor().execute(
+        """UPDATE http_validators SET schema_hash = 'other',
+        metadata = json_set(metadata, '$.valid', json('false'))"""
+    )
+
+    run_getter(getter_args)
+    assert_expected_output()
+
+
+def test_cache_gc(test_server):
+    """gc evicts the cached validations and database rows along with the files"""
+    cache.delete_cache()
+
+    getter_args = DatagetterArgs()
+    getter_args.incremental = True
+
+    run_getter(getter_args)
+    assert cache.stats()["validations"] > 0
+
+    # Within a budget that fits everything nothing goes
+    assert cache.gc(max_bytes=1024**3)["evicted"] == 0
+
+    removed = cache.gc(max_bytes=0, max_age=0)
+    assert removed["evicted"] > 0
+    assert removed["evicted_validations"] > 0
+
+    stats = cache.stats()
+    for key in ["conversions", "originals", "validations", "extensions", "files"]:
+        assert stats[key] == 0
+    assert cache.get_history() == {}
+    assert cache.verify() == []
+
+    run_getter(getter_args)
+    assert_expected_output()
+
+
+def test_cache_upgrade(test_server):
+    """The conversions in a cache made before the tables were versioned are kept"""
+    cache.delete_cache()
+
+    # As the cache was then, with each conversion stored by identifier
+    os.makedirs(cache.CACHE_DIR)
+    with open(os.path.join(cache.CACHE_DIR, "validfile.json"), "w") as fp:
+        json.dump({"grants": []}, fp)
+    con = apsw.Connection(cache.DATABASE_NAME)
+    con.cursor().execute("""CREATE TABLE cache
+        (original_file_name TEXT NOT NULL UNIQUE,
+        hash TEXT NOT NULL UNIQUE,
+        json_file TEXT NOT NULL UNIQUE);
+        INSERT INTO cache VALUES ('validfile.xlsx', 'abc123', 'validfile.json'),
+        ('gonefile.xlsx', 'def456', 'gonefile.json');""")
+    con.close()
+
+    cache.setup_database()
+    cache.setup_cache_dir()
+
+    # Its hashes were SHA-1
+    assert cache.current_hash_algorithm() == "sha1"
+
+    json_file = cache.get_file("abc123")
+    assert json_file == os.path.join(cache.CACHE_DIR, "json", "abc123.json")
+    with open(json_file) as fp:
+        assert json.load(fp) == {"grants": []}
+    assert not os.path.exists(os.path.join(cache.CACHE_DIR, "validfile.json"))
+
+    # Without its JSON there's nothing to keep
+    assert cache.get_file("def456") is False
+    assert cache.verify() == []
+
+
+def test_cache_extensions(test_server):
+    """Each file keeps its own extensions when its dataset moves on to another file"""
+    cache.delete_cache()
+    cache.setup_database()
+
+    cache.update_extensions("old-hash", "a-dataset", ["old"])
+    cache.update_extensions("new-hash", "a-dataset", ["new"])
+
+    assert cache.get_extensions("old-hash", "a-dataset") == ["old"]
+    assert cache.get_extensions("new-hash", "a-dataset") == ["new"]
+    # An unseen file expects the extensions of the dataset's latest one
+    assert cache.get_extensions("other-hash", "a-dataset") == ["new"]
+    assert cache.get_extensions("other-hash", "other-dataset") is None
+
+
+def test_validation_cache(test_server, tmp_path, monkeypatch):
+    """
+    Content validated before against the same schemas isn't validated again, but
+    is against different schemas
+    """
+    cache.delete_cache()
+    cache.setup_database()
+    monkeypatch.setattr(getter.get, "schema_hashes", {})
+
+    validated = []
+
+    def invalid(working_dir, schema_360, data):
+        validated.append(schema_360)
+        raise ValidationError(1, [("error", [])])
+
+    monkeypatch.setattr(getter.get, "validate", invalid)
+
+    schemas = []
+    for version in ["1", "2"]:
+        schema_file = tmp_path / f"schema-{version}.json"
+        schema_file.write_text(json.dumps({"version": version}))
+        package_file = tmp_path / "package-schema.json"
+        package_file.write_text("{}")
+        schemas.append(
+            types.SimpleNamespace(
+                schema_file=str(schema_file), pkg_schema_file=str(package_file)
+            )
+        )
+
+    def validate_file(schema_360):
+        with pytest.raises(ValidationError) as e:
+            getter.get.validate_file(
+                str(tmp_path), schema_360, None, "file-hash", data={"grants": []}
+            )
+        assert e.value.errors_count == 1
+
+    validate_file(schemas[0])
+    assert validated == [schemas[0]]
+    # The outcome is reused, errors and all
+    validate_file(schemas[0])
+    assert validated == [schemas[0]]
+
+    # Another schema hash misses
+    validate_file(schemas[1])
+    assert validated == [schemas[0], schemas[1]]
+
+
+def test_offline_output(test_server):
+    """A run with --offline uses the schemas stored by the run before"""
+    cache.delete_cache()
+
+    run_getter(DatagetterArgs())
+
+    getter_args = DatagetterArgs()
+    getter_args.offline = True
+
+    run_getter(getter_args)
+    assert_expected_output()
+
+
+def test_registry_diff_output(test_server):
+    """An unchanged registry carries forward the datasets the first run downloaded"""
+    cache.delete_cache()
+
+    getter_args = DatagetterArgs()
+    run_getter(getter_args)
+
+    getter_args.registry_diff = True
+    get(getter_args)
+    assert_expected_output()
+
+    with open(os.path.join(getter_args.data_dir, "registry_diff.json")) as fp:
+        registry_diff = json.load(fp)
+    with open(os.path.join(getter_args.data_dir, "data_all.json")) as fp:
+        data_all = json.load(fp)
+
+    assert registry_diff["unchanged"] == [item["identifier"] for item in data_all]
+    assert registry_diff["retried"] == [
+        item["identifier"]
+        for item in data_all
+        if not item["datagetter_metadata"]["downloads"]
+    ]
+    assert not registry_diff["added"] + registry_diff["changed"]
+
+
+def test_resume_output(test_server):
+    """A run resumed after dying part way through gives the same output as one run"""
+    cache.delete_cache()
+
+    getter_args = DatagetterArgs()
+    run_getter(getter_args)
+
+    # As if the run had died while writing its second journal line, and
+    # downloading the next dataset
+    journal_file = os.path.join(getter_args.data_dir, "data_journal.jsonl")
+    with open(journal_file) as fp:
+        lines = fp.readlines()
+    with open(journal_file, "w") as fp:
+        fp.write(lines[0] + lines[1][: len(lines[1]) // 2])
+
+    finished = json.loads(lines[0])["dataset"]["identifier"]
+    unfinished = [
+        identifier
+        for identifier in ["aninvalidfile", "conversionerrorsfile", "validfile"]
+        if identifier != finished
+    ]
+    part_file = os.path.join(
+        getter_args.data_dir, "original", f"{unfinished[0]}.xlsx.tmp1234.part"
+    )
+    with open(part_file, "wb") as fp:
+        fp.write(b"PK")
+
+    for file_name in os.listdir(getter_args.data_dir):
+        if file_name.startswith("data_") and file_name.endswith(".json"):
+            os.unlink(os.path.join(getter_args.data_dir, file_name))
+
+    getter_args.resume = True
+    get(getter_args)
+    assert_expected_output()
+
+    assert not os.path.exists(part_file)
+    with open(journal_file) as fp:
+        journal = [json.loads(line)["dataset"]["identifier"] for line in fp]
+    assert sorted(journal) == sorted(
+        json.loads(line)["dataset"]["identifier"] for line in lines
+    )
+
+
+def test_resume_download(test_server, tmp_path, monkeypatch):
+    """
+    A resumed original keeps to --publishers, and to the validators recorded for
+    its content against the same schemas
+    """
+    cache.delete_cache()
+    cache.setup_database()
+
+    getter_args = DatagetterArgs()
+    getter_args.data_dir = str(tmp_path)
+    getter_args.resume = True
+    getter_args.incremental = True
+
+    url = "http://example.com/a.xlsx"
+    dataset = {
+        "identifier": "a",
+        "publisher": {"prefix": "360G-a"},
+        "license": getter.get.acceptable_licenses[0],
+        "distribution": [{"downloadURL": url}],
+    }
+    os.makedirs(tmp_path / "original")
+    original_file = tmp_path / "original" / "a.xlsx"
+    original_file.write_bytes(b"PK")
+    file_hash_str = cache.hash_file(str(original_file))
+
+    monkeypatch.setattr(getter.get, "schema_files_hash", lambda *paths: "schemas")
+    # Downloading again instead
+    monkeypatch.setattr(
+        getter.get,
+        "fetch_dataset",
+        lambda args, dataset, schema_hash_str=None: (dataset, None),
+    )
+
+    def resume():
+        return getter.get.fetch(getter_args, dict(dataset), None, None)[1]
+
+    cache.update_validators(
+        url, '"1"', None, file_hash_str, "xlsx", "main", "schemas", True, {}
+    )
+    download = resume()
+    assert download["etag"] == '"1"'
+    assert download["schema_hash_str"] == "schemas"
+
+    # Validators recorded for other content
+    cache.update_validators(
+        url, '"2"', None, "other", "xlsx", "main", "schemas", True, {}
+    )
+    download = resume()
+    assert download["etag"] is None
+    assert download["schema_hash_str"] == "schemas"
+
+    getter_args.publisher_prefixes = ["360G-b"]
+    assert resume() is None
+
+    getter_args.publisher_prefixes = None
+    dataset["license"] = "an unrecognised licence"
+    assert resume() is None
+
+
+def test_compressed_output(test_server):
+    """A run with --compress gives the same output, compressed"""
+    cache.delete_cache()
+
+    getter_args = DatagetterArgs()
+    getter_args.compress = "gzip"
+
+    run_getter(getter_args)
+    assert_expected_output()
+
+    for file_path in ["json_all/validfile.json.gz", "original/validfile.xlsx.gz"]:
+        assert os.path.exists(os.path.join(getter_args.data_dir, file_path))
+
+
+@pytest.mark.parametrize("incremental", [True, False])
+@pytest.mark.parametrize("compress", [(None, "gzip"), ("gzip", None)])
+def test_compressed_cache_reuse(test_server, incremental, compress):
+    """A cache written with or without --compress is reused by a run with the other"""
+    cache.delete_cache()
+
+    getter_args = DatagetterArgs()
+    getter_args.incremental = incremental
+
+    getter_args.compress = compress[0]
+    run_getter(getter_args)
+
+    getter_args.compress = compress[1]
+    run_getter(getter_args)
+    assert_expected_output()
+
+    suffix = compression.SUFFIXES.get(compress[1], "")
+    for file_path in ["json_all/validfile.json", "original/validfile.xlsx"]:
+        file_path = os.path.join(getter_args.data_dir, file_path)
+        assert compression.find(file_path) == file_path + suffix
+
+    assert cache.verify() == []
+
+
+@pytest.mark.parametrize("incremental", [True, False])
+def test_hash_algorithm_migration(test_server, incremental):
+    """A cache keyed with SHA-1 is rekeyed for the next run with BLAKE2b"""
+    cache.delete_cache()
+
+    getter_args = DatagetterArgs()
+    getter_args.hash_algorithm = "sha1"
+    getter_args.incremental = incremental
+    run_getter(getter_args)
+
+    # Opening the cache without asking for an algorithm (as the cache
+    # commands do) keeps it as it is
+    stats = cache.stats()
+    assert stats["conversions"] > 0
+    assert stats["validations"] > 0
+    cache.setup_database()
+    assert cache.stats()["hash_algorithm"] == "sha1"
+    assert cache.stats()["conversions"] == stats["conversions"]
+
+    # The conversions are kept whether or not the originals were kept for
+    # conditional requests, and the validations as the stored schemas are
+    # rehashed too
+    getter_args.hash_algorithm = "blake2b"
+    cache.setup_database(getter_args.hash_algorithm)
+    assert cache.stats()["conversions"] == stats["conversions"]
+    assert cache.stats()["validations"] == stats["validations"]
+
+    run_getter(getter_args)
+    assert_expected_output()
+
+    if incremental:
+        # The outcomes of the unmodified downloads are still found
+        assert_not_downloaded()
+
+    assert cache.stats()["hash_algorithm"] == "blake2b"
+    assert cache.stats()["conversions"] == stats["conversions"]
+    assert cache.verify() == []
+
+
+def test_sharded_output(test_server):
+    """Two shards merged give the same output as one run"""
+    cache.delete_cache()
+
+    shard_dirs = []
+    for index in range(2):
+        getter_args = DatagetterArgs()
+        getter_args.shard = (index, 2)
+        getter_args.grants_ndjson = True
+        getter_args.data_dir = os.path.join(
+            TEST_DATA_DIR, f"fetched_output_shard{index}"
+        )
+        run_getter(getter_args)
+        shard_dirs.append(getter_args.data_dir)
+
+    merge_args = DatagetterArgs()
+    merge_args.shard_dirs = shard_dirs
+    shutil.rmtree(merge_args.data_dir, ignore_errors=True)
+    merge(merge_args)
+
+    assert_expected_output()
+    assert os.path.exists(os.path.join(merge_args.data_dir, "grants_all.ndjson"))
+
+    # A shard of another registry is turned away
+    shard_file = os.path.join(shard_dirs[1], shard.SHARD_FILE)
+    with open(shard_file) as fp:
+        shard_info = json.load(fp)
+    with open(shard_file, "w") as fp:
+        json.dump(dict(shard_info, registry_digest="other"), fp)
+    with pytest.raises(shard.ShardError):
+        merge(merge_args)
+    with open(shard_file, "w") as fp:
+        json.dump(shard_info, fp)
+
+    # As is a dataset in both shards
+    data_all_files = [
+        os.path.join(shard_dir, "data_all.json") for shard_dir in shard_dirs
+    ]
+    with open(data_all_files[0]) as fp:
+        first_dataset = json.load(fp)[0]
+    with open(data_all_files[1]) as fp:
+        data_all = json.load(fp)
+    with open(data_all_files[1], "w") as fp:
+        json.dump(data_all + [first_dataset], fp)
+    with pytest.raises(shard.ShardError):
+        merge(merge_args)
+
+    for shard_dir in shard_dirs:
+        shutil.rmtree(shard_dir)
+
+
+def test_pipeline_output(test_server):
+    cache.delete_cache()
+
+    getter_args = DatagetterArgs()
+    getter_args.pipeline = True
+
+    run_getter(getter_args)
+
+    assert_expected_output()
+
+
+def test_worker_recycling_output(test_server):
+    """Workers replaced after every dataset, with every file in the large file lane"""
+    cache.delete_cache()
+
+    getter_args = DatagetterArgs()
+    getter_args.threads = 2
+    getter_args.max_tasks_per_child = 1
+    getter_args.worker_max_rss = 1
+    getter_args.large_file_size = 0
+
+    run_getter(getter_args)
+    assert_expected_output()
+
+    getter_args.pipeline = True
+
+    run_getter(getter_args)
+    assert_expected_output()
+
+
+def test_chunked_validation_output(test_server):
+    """Files with more than one grant validated a grant at a time"""
+    cache.delete_cache()
+
+    getter_args = DatagetterArgs()
+    getter_args.validation_chunk_size = 1
+
+    run_getter(getter_args)
+    assert_expected_output()
+
+    getter_args.pipeline = True
+    getter_args.large_file_size = 0
+
+    run_getter(getter_args)
+    assert_expected_output()
+
+
+def schedule_jobs(identifiers):
+    return [
+        (
+            index,
+            {
+                "identifier": identifier,
+                "distribution": [{"downloadURL": f"http://example.com/{identifier}"}],
+            },
+        )
+        for index, identifier in enumerate(identifiers)
+    ]
+
+
+@pytest.mark.parametrize(
+    "head_sizes, order",
+    [
+        (True, ["unknown", "big", "slow", "fast", "small"]),
+        (False, ["small", "unknown", "big", "slow", "fast"]),
+    ],
+)
+def test_longest_first(monkeypatch, head_sizes, order):
+    """
+    Datasets are ordered by their time last run, or their size (by a HEAD
+    request with --head-sizes) at the rate of the rest, with those with
+    neither first
+    """
+    # 100 bytes a second
+    history = {"slow": ("xlsx", 1000, 10.0), "fast": ("xlsx", 100, 1.0)}
+    monkeypatch.setattr(cache, "get_history", lambda: history)
+    head_requests = []
+
+    def head_content_length(url):
+        head_requests.append(url)
+        return {"http://example.com/big": 5000, "http://example.com/small": 50}.get(url)
+
+    monkeypatch.setattr(getter.get, "head_content_length", head_content_length)
+
+    getter_args = DatagetterArgs()
+    getter_args.head_sizes = head_sizes
+
+    jobs = schedule_jobs(["fast", "small", "unknown", "slow", "big"])
+    scheduled = getter.get.longest_first(getter_args, jobs, [], {})
+
+    assert [dataset["identifier"] for _, dataset in scheduled] == order
+    assert len(head_requests) == (3 if head_sizes else 0)
+
+
+def test_longest_first_without_rates(monkeypatch):
+    """Sizes without a rate to convert them to seconds aren't compared with seconds"""
+    previous_data_all = [
+        {"identifier": "big", "datagetter_metadata": {"file_size": 10**9}},
+        {"identifier": "small", "datagetter_metadata": {"file_size": 10}},
+    ]
+    jobs = schedule_jobs(["small", "slow", "big"])
+
+    # Only sizes, which can be compared with each other
+    monkeypatch.setattr(cache, "get_history", lambda: {})
+    scheduled = getter.get.longest_first(DatagetterArgs(), jobs, previous_data_all, {})
+    assert [dataset["identifier"] for _, dataset in scheduled] == [
+        "slow",
+        "big",
+        "small",
+    ]
+
+    # A time but no sizes to work out a rate from
+    monkeypatch.setattr(cache, "get_history", lambda: {"slow": (None, None, 5.0)})
+    scheduled = getter.get.longest_first(DatagetterArgs(), jobs, previous_data_all, {})
+    assert [dataset["identifier"] for _, dataset in scheduled] == [
+        "small",
+        "big",
+        "slow",
+    ]
+
+
+@pytest.mark.parametrize(
+    "max_tasks, max_rss, workers", [(2, None, 3), (None, 1, 6), (None, None, 1)]
+)
+def test_worker_recycling(max_tasks, max_rss, workers):
+    """Workers are replaced after max_tasks tasks, or after using over max_rss bytes"""
+    pids = []
+    with RecyclingPool(
+        multiprocessing.get_context(), 1, max_tasks=max_tasks, max_rss=max_rss
+    ) as pool:
+        for _ in range(6):
+            pool.apply_async(os.getpid, callback=pids.append)
+
+    assert len(pids) == 6
+    assert len(set(pids)) == workers
+    assert os.getpid() not in pids
+
+
+def fetch_and_convert_or_die(job):
+    """Kills the worker instead of fetching the second dataset"""
+    _, index, dataset, _, _ = job
+    if index == 1:
+        os._exit(1)
+    return index, dict(dataset, fetched=True), None
+
+
+def test_worker_killed(monkeypatch):
+    """A worker killed part way through fails its dataset, not the run"""
+    # Forked, so the workers have the stand in for fetch_and_convert_job
+    monkeypatch.setattr(
+        getter.get, "pool_context", lambda args: multiprocessing.get_context("fork")
+    )
+    monkeypatch.setattr(getter.get, "fetch_and_convert_job", fetch_and_convert_or_die)
+
+    getter_args = DatagetterArgs()
+    getter_args.threads = 2
+    getter_args.max_tasks_per_child = 100
+
+    jobs = [(index, {"identifier": str(index)}) for index in range(4)]
+    results = dict(getter.get.run_pool(getter_args, jobs, None, None, {}))
+
+    assert results == {
+        0: {"identifier": "0", "fetched": True},
+        1: {"identifier": "1"},
+        2: {"identifier": "2", "fetched": True},
+        3: {"identifier": "3", "fetched": True},
+    }
+
+
+def test_session_pool_size(monkeypatch):
+    """A session made before the download limits are set is resized for them"""
+    monkeypatch.setattr(getter.get, "session", None)
+    monkeypatch.setattr(getter.get, "host_concurrency", None)
+
+    # e.g. fetching the schemas
+    adapter = get_session().get_adapter("http://localhost/")
+    assert adapter._pool_maxsize == 10
+
+    getter.get.configure_downloads({}, 32)
+    adapter = get_session().get_adapter("http://localhost/")
+    assert adapter._pool_maxsize == 32
+
+
+def test_host_concurrency(monkeypatch):
+    """No more than host_concurrency downloads are in progress from each host"""
+    hosts = ["a.example.com", "b.example.com"]
+    data_all = [
+        {
+            "identifier": f"{host}-{index}",
+            "distribution": [{"downloadURL": f"http://{host}/{index}.xlsx"}],
+        }
+        for host in hosts
+        for index in range(6)
+    ]
+
+    in_progress = {host: 0 for host in hosts}
+    most_in_progress = {host: 0 for host in hosts}
+    lock = threading.Lock()
+
+    def fetch_dataset(args, dataset, schema_hash_str=None):
+        host = getter.get.dataset_host(dataset)
+        with lock:
+            in_progress[host] += 1
+            most_in_progress[host] = max(most_in_progress[host], in_progress[host])
+        time.sleep(0.05)
+        with lock:
+            in_progress[host] -= 1
+        return dataset, None
+
+    monkeypatch.setattr(getter.get, "fetch_dataset", fetch_dataset)
+    # Restored after the test
+    monkeypatch.setattr(getter.get, "host_semaphores", {})
+    monkeypatch.setattr(getter.get, "host_concurrency", None)
+    monkeypatch.setattr(getter.get, "session", None)
+
+    getter.get.configure_downloads(getter.get.host_semaphores_for(data_all, 2), 2)
+
+    threads = [
+        threading.Thread(
+            target=getter.get.fetch, args=(DatagetterArgs(), dataset, None, None)
+        )
+        for dataset in data_all
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert most_in_progress == {host: 2 for host in hosts}
+
+
+def convert_or_fail(args, dataset, download, schema_path, schema_package_path):
+    """Fails to convert every dataset but the last"""
+    if dataset["identifier"] != "5":
+        raise ValueError("Conversion failed")
+    return dict(dataset, converted=True)
+
+
+def test_pipeline_conversion_failed(monkeypatch):
+    """A failed conversion frees its place in the queue for the next download"""
+    # Forked, so the workers have the stand in for convert_and_validate
+    monkeypatch.setattr(
+        getter.get, "pool_context", lambda args: multiprocessing.get_context("fork")
+    )
+    monkeypatch.setattr(
+        getter.get,
+        "fetch",
+        lambda args, dataset, schema_path, schema_package_path: (
+            dataset,
+            {"file_size": 1},
+        ),
+    )
+    monkeypatch.setattr(getter.get, "convert_and_validate", convert_or_fail)
+    # A single place, which the failures would take for good if not freed
+    monkeypatch.setattr(getter.get, "PIPELINE_QUEUE_FACTOR", 1)
+
+    getter_args = DatagetterArgs()
+    getter_args.pipeline = True
+
+    jobs = [(index, {"identifier": str(index)}) for index in range(6)]
+    results = {}
+
+    def run_pipeline():
+        results.update(getter.get.run_pipeline(getter_args, jobs, None, None))
+
+    thread = threading.Thread(target=run_pipeline, daemon=True)
+    thread.start()
+    thread.join(timeout=60)
+
+    assert not thread.is_alive()
+    assert results == {
+        **{index: {"identifier": str(index)} for index in range(5)},
+        5: {"identifier": "5", "converted": True},
+    }
+
+
+def test_chunk_errors():
+    """A chunk's errors are numbered within the whole file"""
+    assert grant_index("grants/12/amountAwarded") == 12
+    assert grant_index("grants/3") == 3
+    assert grant_index("grants") is None
+    assert grant_index("fundingOrganization/0/id") is None
+
+    errors = [
+        ('{"message": "a"}', [{"path": "grants/0/title"}, {"path": "grants/2"}]),
+        ('{"message": "b"}', [{"path": "grants"}, {"path": ""}]),
+    ]
+
+    assert chunk_errors(errors, 10) == [
+        ('{"message": "a"}', [{"path": "grants/10/title"}, {"path": "grants/12"}]),
+    ]
+    # The pass with stub grants only keeps the errors outside the grants
+    assert chunk_errors(errors, None) == [
+        ('{"message": "b"}', [{"path": "grants"}, {"path": ""}]),
+    ]
+
+
+def test_chunked_validation_errors(test_server, tmp_path):
+    """Validating a file in chunks finds the same errors as validating it whole"""
+    cache.delete_cache()
+
+    getter_args = DatagetterArgs()
+    run_getter(getter_args)
+
+    base_url = "https://raw.githubusercontent.com/ThreeSixtyGiving/standard"
+    schema_path, schema_package_path = (
+        schema_store.fetch(
+            get_session(),
+            f"{base_url}/{getter_args.schema_branch}/schema/{file_name}",
+            getter_args.schema_branch,
+            offline=True,
+        )
+        for file_name in schema_store.SCHEMA_FILES
+    )
+
+    data = load_json(
+        os.path.join(getter_args.data_dir, "json_all", "aninvalidfile.json")
+    )
+    schema_360, _ = get_schema_360(
+        str(tmp_path / "schema"), schema_path, schema_package_path, data
+    )
+
+    os.makedirs(tmp_path / "whole")
+    with pytest.raises(ValidationError) as whole:
+        validate(str(tmp_path / "whole"), schema_360, data)
+
+    validator = ChunkValidator(2)
+    configure_validation(validator, 1)
+    try:
+        os.makedirs(tmp_path / "chunked")
+        with pytest.raises(ValidationError) as chunked:
+            validate_chunks(str(tmp_path / "chunked"), schema_360, data)
+    finally:
+        configure_validation(None, None)
+        validator.close()
+
+    assert len(data["grants"]) > 1
+    assert chunked.value.errors_count == whole.value.errors_count
+    assert chunked.value.errors == whole.value.errors
+
+
+def test_grants_ndjson_output(test_server):
+    cache.delete_cache()
+
+    getter_args = DatagetterArgs()
+    getter_args.grants_ndjson = True
+
+    run_getter(getter_args)
+    assert_expected_output()
+
+    # Each grants_<name>.ndjson has the grants of the datasets in json_<name>
+    for name in ["all", "valid", "acceptable_license", "acceptable_license_valid"]:
+        json_dir = os.path.join(getter_args.data_dir, f"json_{name}")
+        expected = [
+            (file_name[: -len(".json")], grant)
+            for file_name in sorted(os.listdir(json_dir))
+            for grant in json.load(open(os.path.join(json_dir, file_name)))["grants"]
+        ]
+
+        with open(os.path.join(getter_args.data_dir, f"grants_{name}.ndjson")) as fp:
+            lines = [json.loads(line) for line in fp]
+        fetched = [(line["dataset_identifier"], line["grant"]) for line in lines]
+
+        assert sorted(fetched, key=json.dumps) == sorted(expected, key=json.dumps)
+
+
+def test_grants_index_output(test_server):
+    cache.delete_cache()
+
+    getter_args = DatagetterArgs()
+    getter_args.grants_index = True
+
+    run_getter(getter_args)
+    assert_expected_output()
+
+    # The index has a row for each grant in json_all
+    json_dir = os.path.join(getter_args.data_dir, "json_all")
+    expected = sorted(
+        (grant["id"], file_name[: -len(".json")])
+        for file_name in os.listdir(json_dir)
+        for grant in json.load(open(os.path.join(json_dir, file_name)))["grants"]
+    )
+
+    con = apsw.Connection(os.path.join(getter_args.data_dir, "grants_index.db"))
+    fetched = sorted(
+        con.cursor().execute("SELECT grant_id, dataset_identifier FROM grants")
+    )
+
+    assert fetched == expected